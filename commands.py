@@ -2,60 +2,167 @@
 import os
 import sublime_plugin
 import sublime
+import typing
 
+from . import libbenchmark
+from . import libcaches
 from . import libgit
+from . import libmerged
 from . import libtree
 from . import libmodify
 from . import libcodereview
+from . import libgerrit
+from . import libmetrics
+from . import libnavigator
+from . import libopenqueue
+from . import libpoller
+from . import libprefetch
+from . import libpublish
+from . import librecord
+from . import librepo
+from . import librun
+from . import libscheduler
+from . import libsnapshot
+from . import libworktree
 
 
 class NestableCommand(sublime_plugin.WindowCommand):
   def run(self, **kwargs):
     try:
-      if self._run(**kwargs):
-        for task, args in kwargs.get('then', []):
-          print(f'running subtask {task}')
-          self.window.run_command(task, args)
+      result = self._run(**kwargs)
+      if result is None:
+        # The command finishes asynchronously and runs its own subtasks.
+        return
+      if result:
+        self._RunSubtasks(kwargs.get('then', []))
       else:
         print('command failed. not running subtasks!')
     except Exception as e:
       print(f'exception occurred running task: {e}')
       raise e
 
+  # Links from the branch status sheet name their checkout; everything else
+  # works on the checkout of the active file.
+  def _Repository(self, checkout=None) -> librepo.Repository:
+    if checkout:
+      return librepo.Get(checkout)
+    return librepo.ForWindow(self.window)
+
+  def _RunSubtasks(self, then):
+    for task, args in then:
+      print(f'running subtask {task}')
+      self.window.run_command(task, args)
+
 
 class CrOpenChangedFiles(NestableCommand):
-  def _run(self, **kwargs) -> bool:
+  def _run(self, checkout=None, **kwargs) -> bool:
     settings = sublime.load_settings("Chromium.sublime-settings")
-    checkout = settings['chromium_checkout']
+    checkout = self._Repository(checkout).root
     current_branch = libgit.Gerrit.Current(checkout)
-    for file in current_branch.FileChangeList():
-      self.window.open_file(fname=os.path.join(checkout, file))
+    queue = libopenqueue.OpenQueue(self.window, checkout,
+                                   current_branch.FileChangeList(),
+                                   settings.get('open_files_batch_size', 4),
+                                   settings.get('open_files_batch_delay_ms', 250))
+    queue.Start(libgerrit.GerritProjectInfo.ForCheckout(checkout))
     return True
 
 
 class CrShowBranchStatus(NestableCommand):
-  def _run(self, **kwargs):
-    settings = sublime.load_settings("Chromium.sublime-settings")
-    checkout = settings['chromium_checkout']
+  def _run(self, checkout=None, **kwargs):
+    checkout = self._Repository(checkout).root
     html_content = libtree.RenderAllPatches(checkout)
     self.window.new_html_sheet('branch_state', html_content)
+    libprefetch.PrefetchBranches(libtree.RenderedBranches(checkout))
+    return True
+
+
+class CrToggleBranchExpansion(NestableCommand):
+  def _run(self, branch, expand, checkout=None, **kwargs):
+    libtree.SetExpansion(self._Repository(checkout).root, branch, expand)
     return True
 
 
 class CrCheckoutAndRebaseBranch(NestableCommand):
-  def _run(self, branch, then, **kwargs):
-    settings = sublime.load_settings("Chromium.sublime-settings")
-    checkout = settings['chromium_checkout']
+  def _run(self, branch, then, checkout=None, **kwargs):
+    checkout = self._Repository(checkout).root
+    libmerged.Forget(checkout)
     return libmodify.CheckoutAndRebaseBranch(checkout, branch)
 
 
 class CrCheckoutBranch(NestableCommand):
-  def _run(self, branch, then, **kwargs):
-    settings = sublime.load_settings("Chromium.sublime-settings")
-    checkout = settings['chromium_checkout']
+  def _run(self, branch, then, checkout=None, **kwargs):
+    checkout = self._Repository(checkout).root
     return libmodify.CheckoutBranch(checkout, branch)
 
 
+class CrRebaseAllBranches(NestableCommand):
+  def _run(self, then=(), checkout=None, **kwargs):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    repository = self._Repository(checkout)
+    checkout = repository.root
+    workers = settings.get('rebase_workers', 4)
+    def Rebase():
+      results = libworktree.RebaseAllBranches(checkout, workers)
+      libmerged.Forget(checkout)
+      conflicts = [r for r in results.values() if r.IsConflict()]
+      sublime.status_message(
+        f'Rebased {len(results)} branches, {len(conflicts)} with conflicts')
+      sublime.set_timeout(lambda: self._RunSubtasks(then))
+    sublime.status_message('Rebasing all branches...')
+    repository.Submit(libscheduler.INTERACTIVE, Rebase,
+                      key=('rebase', checkout))
+    return None
+
+
+class CrFindMergedBranches(NestableCommand):
+  def _run(self, then=(), checkout=None, **kwargs):
+    repository = self._Repository(checkout)
+    checkout = repository.root
+    def Find():
+      merged = libmerged.FindMergedBranches(checkout)
+      sublime.status_message(f'Found {len(merged)} merged branches')
+      sublime.set_timeout(lambda: self._RunSubtasks(then))
+    sublime.status_message('Looking for merged branches...')
+    repository.Submit(libscheduler.INTERACTIVE, Find,
+                      key=('find_merged', checkout))
+    return None
+
+
+class CrDeleteMergedBranches(NestableCommand):
+  def _run(self, then=(), branches=(), checkout=None, **kwargs):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    repository = self._Repository(checkout)
+    checkout = repository.root
+    workers = settings.get('rebase_workers', 4)
+    # Deleting these loses their commits which didn't land, so ask first.
+    merged = libmerged.LastResults(checkout)
+    unlanded = [branchname for branchname in branches if branchname in merged
+                and merged[branchname].reason != 'landed']
+    if unlanded and not sublime.ok_cancel_dialog(
+        'These changes are merged in gerrit, but the branches have commits '
+        'which never landed upstream. Deleting them loses those commits:\n\n'
+        + '\n'.join(unlanded), 'Delete'):
+      unlanded = []
+    def Delete():
+      try:
+        deleted = libmerged.DeleteMergedBranches(checkout, branches, workers,
+                                                 force=unlanded)
+      except Exception as e:
+        sublime.status_message(f'Could not delete merged branches: {e}')
+        return
+      skipped = len(branches) - len(deleted)
+      message = f'Deleted {len(deleted)} merged branches'
+      if skipped:
+        message += (f', kept {skipped} (checked out, not confirmed, no longer'
+                    ' merged, or a branch or child which could not be rebased)')
+      sublime.status_message(message)
+      sublime.set_timeout(lambda: self._RunSubtasks(then))
+    sublime.status_message('Deleting merged branches...')
+    repository.Submit(libscheduler.INTERACTIVE, Delete,
+                      key=('delete_merged', checkout))
+    return None
+
+
 class CrCloseActiveBranchStatus(NestableCommand):
   def _run(self, **kwargs):
     self.window.active_sheet().close(on_close=lambda x:x)
@@ -67,6 +174,192 @@ class CrUploadPatchWithComments(NestableCommand):
     return True
 
 
+class CrPublishDrafts(NestableCommand):
+  def _run(self, then=(), checkout=None, **kwargs):
+    repository = self._Repository(checkout)
+    checkout = repository.root
+    project = libgerrit.GerritProjectInfo.ForCheckout(checkout)
+    def Publish():
+      try:
+        published = libpublish.PublishDrafts(project, checkout)
+      except Exception as e:
+        sublime.status_message(f'Could not publish drafts: {e}')
+        return
+      sublime.status_message(f'Published drafts in {len(published)} files')
+      for view in self.window.views():
+        if view.file_name() in published:
+          libcodereview.RenderCommentsForView(view)
+      sublime.set_timeout(lambda: self._RunSubtasks(then))
+    repository.Submit(libscheduler.INTERACTIVE, Publish,
+                      key=('publish', project.server,
+                           project.upstream_change_id))
+    return None
+
+
+class _UnresolvedCommentCommand(NestableCommand):
+  def _WithIndex(self, callback):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    repository = self._Repository()
+    checkout = repository.root
+    pending_responses = settings['pending_responses']
+    project = libgerrit.GerritProjectInfo.ForCheckout(checkout)
+    server, change_id = project.server, project.upstream_change_id
+    def Load():
+      try:
+        snapshot = libsnapshot.Revalidate(
+          server, change_id, libsnapshot.Load(server, change_id))
+      except Exception as e:
+        sublime.status_message(f'Could not load comments: {e}')
+        return
+      index = libnavigator.IndexForSnapshot(
+        snapshot, checkout, project,
+        lambda filename: self._CurrentText(checkout, filename))
+      skip = libnavigator.LocallyResolvedThreads(pending_responses, change_id)
+      sublime.set_timeout(lambda: callback(checkout, index, skip))
+    repository.Submit(libscheduler.INTERACTIVE, Load)
+
+  # Open files may have unsaved edits, which the phantoms already follow.
+  def _CurrentText(self, checkout:str, filename:str) -> typing.Optional[str]:
+    path = os.path.join(checkout, filename)
+    view = self.window.find_open_file(path)
+    if view is not None:
+      return view.substr(sublime.Region(0, view.size()))
+    try:
+      with open(path) as f:
+        return f.read()
+    except (OSError, ValueError):
+      return None
+
+  def _CurrentPosition(self, checkout:str) -> (str, int):
+    view = self.window.active_view()
+    if view is None or not (view.file_name() or '').startswith(checkout):
+      return ('', 0)
+    row = view.rowcol(view.sel()[0].begin())[0] if view.sel() else 0
+    return (os.path.relpath(view.file_name(), checkout), row + 1)
+
+  def _Open(self, checkout:str, thread:libnavigator.UnresolvedThread):
+    path = os.path.join(checkout, thread.filename)
+    self.window.open_file(f'{path}:{thread.line}', sublime.ENCODED_POSITION)
+
+
+class CrNextUnresolvedComment(_UnresolvedCommentCommand):
+  def _run(self, forward=True, then=(), **kwargs):
+    def Navigate(checkout, index, skip):
+      filename, line = self._CurrentPosition(checkout)
+      if forward:
+        thread = index.Next(filename, line, skip)
+      else:
+        thread = index.Previous(filename, line, skip)
+      if thread is None:
+        sublime.status_message('No unresolved comments in this change')
+        return
+      self._Open(checkout, thread)
+      self._RunSubtasks(then)
+    self._WithIndex(Navigate)
+    return None
+
+
+class CrListUnresolvedComments(_UnresolvedCommentCommand):
+  def _run(self, **kwargs):
+    def Show(checkout, index, skip):
+      threads = [t for t in index.threads if t.root_id not in skip]
+      if not threads:
+        sublime.status_message('No unresolved comments in this change')
+        return
+      def OnSelect(selected):
+        if selected >= 0:
+          self._Open(checkout, threads[selected])
+      self.window.show_quick_panel(
+        [[f'{t.filename}:{t.line}', f'{t.author}: {t.message}'] for t in threads],
+        OnSelect)
+    self._WithIndex(Show)
+    return None
+
+
+def _TrafficFixturePath(settings, path):
+  if path:
+    return path
+  return settings.get('traffic_fixture_path', None) or os.path.join(
+    sublime.cache_path(), 'SublimeGerrit', 'traffic.jsonl')
+
+
+class CrRecordTraffic(NestableCommand):
+  def _run(self, path=None, **kwargs):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    path = _TrafficFixturePath(settings, path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    librecord.StartRecording(path)
+    sublime.status_message(f'Recording git and gerrit traffic to {path}')
+    return True
+
+
+class CrReplayTraffic(NestableCommand):
+  def _run(self, path=None, latency_scale=0, **kwargs):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    path = _TrafficFixturePath(settings, path)
+    librecord.StartReplay(path, latency_scale)
+    sublime.status_message(f'Replaying git and gerrit traffic from {path}')
+    return True
+
+
+class CrMeasurePayloads(NestableCommand):
+  def _run(self, path=None, **kwargs):
+    settings = sublime.load_settings("Chromium.sublime-settings")
+    path = _TrafficFixturePath(settings, path)
+    savings = libbenchmark.MeasurePayloads(path)
+    self.window.new_html_sheet('Payload sizes',
+                               libbenchmark.RenderHtml(path, savings))
+    return True
+
+
+class CrStopTraffic(NestableCommand):
+  def _run(self, **kwargs):
+    librecord.Stop()
+    sublime.status_message('Using live git and gerrit again')
+    return True
+
+
+class CrShowPerformanceStats(NestableCommand):
+  def _run(self, **kwargs):
+    schedulers = {}
+    for repository in librepo.Repositories():
+      stats = repository.SchedulerStats()
+      if stats is not None:
+        schedulers[repository.root] = stats
+    self.window.new_html_sheet('Performance stats',
+                               libmetrics.RenderHtml(schedulers))
+    return True
+
+
+class CrShowCacheUsage(NestableCommand):
+  def _run(self, then=(), **kwargs):
+    # Sizing every cache entry is too slow for the UI thread.
+    def Render():
+      libcaches.EnforceBudget()
+      html = libcaches.RenderHtml()
+      def Show():
+        self.window.new_html_sheet('Cache usage', html)
+        self._RunSubtasks(then)
+      sublime.set_timeout(Show)
+    self._Repository().Submit(libscheduler.INTERACTIVE, Render,
+                              key=('cache_usage',))
+    return None
+
+
+class CrTrimCaches(NestableCommand):
+  def _run(self, then=(), **kwargs):
+    def Trim():
+      before = sum(usage.bytes for usage in libcaches.Report())
+      evicted = libcaches.Trim()
+      freed = before - sum(usage.bytes for usage in libcaches.Report())
+      sublime.status_message(
+        f'Dropped {evicted} cache entries, about {freed // 1024} KiB')
+      sublime.set_timeout(lambda: self._RunSubtasks(then))
+    self._Repository().Submit(libscheduler.INTERACTIVE, Trim,
+                              key=('trim_caches',))
+    return None
+
+
 class CrNopTrampoline(NestableCommand):
   def _run(self, **kwargs):
     return True
@@ -74,5 +367,44 @@ class CrNopTrampoline(NestableCommand):
 
 class ChangelistFileOpenListener(sublime_plugin.EventListener):
   def on_load_async(self, view:sublime.View):
-    contexts = libcodereview.CreateCommentChainContextsForView(view)
-    libcodereview.RenderContexts(view, contexts)
+    if libopenqueue.IsDeferred(view):
+      return
+    self._RenderComments(view)
+
+  def on_activated_async(self, view:sublime.View):
+    libpoller.NoteActivity()
+    libcodereview.WatchViewport(view)
+    if not libopenqueue.Release(view):
+      return
+    if not view.is_loading():
+      # Otherwise on_load_async will render it now that it's released.
+      self._RenderComments(view)
+
+  def on_selection_modified_async(self, view:sublime.View):
+    libpoller.NoteActivity()
+    libcodereview.RelayoutIfResized(view)
+    libcodereview.RefreshViewport(view)
+
+  def on_close(self, view:sublime.View):
+    libcodereview.ForgetView(view)
+    libopenqueue.Forget(view)
+
+  def _RenderComments(self, view:sublime.View):
+    repository = librepo.ForPath(view.file_name())
+    if repository is None:
+      return
+    project = libgerrit.GerritProjectInfo.ForCheckout(repository.root)
+    window = view.window()
+    lane = libscheduler.VISIBLE
+    if window is not None and window.active_view() == view:
+      lane = libscheduler.INTERACTIVE
+    def Render():
+      libcodereview.RenderCommentsForView(view, project)
+      libcodereview.WatchViewport(view)
+    repository.Submit(lane, Render, key=('render', view.id()))
+
+
+# Reloading the plugin would otherwise leave the old threads running.
+def plugin_unloaded():
+  librepo.Shutdown()
+  librun.Shutdown()
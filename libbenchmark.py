@@ -0,0 +1,80 @@
+import collections
+import json
+import typing
+
+from . import libfetch
+from . import libgerrit
+from . import libmetrics
+from . import librecord
+from . import libsnapshot
+
+
+class PayloadSavings(typing.NamedTuple):
+  payload: str
+  requests: int
+  recorded_bytes: int
+  trimmed_bytes: int
+
+
+def _Size(response_json) -> int:
+  return len(json.dumps(response_json, separators=(',', ':')))
+
+
+def _ChangeFiles(change_json) -> dict:
+  return change_json['revisions'][change_json['current_revision']]['files']
+
+
+# What each recorded payload would have cost with the narrower requests, and
+# what is kept of it once trimmed to the models.
+def _Measure(entry:dict) -> typing.Iterator[typing.Tuple[str, int]]:
+  endpoint = libmetrics.Endpoint(entry['method'], entry['url'])
+  response_json = json.loads(entry['response'][5:])
+  if endpoint == 'GET /changes/*':
+    # An unchanged revalidation only needs the probe; the rest only matters
+    # once something changed.
+    probe = {k: v for k, v in response_json.items()
+             if k not in ('revisions', 'current_revision')}
+    yield 'change revalidation', _Size(probe)
+    yield 'change', _Size(libfetch.TrimToType(libgerrit.ChangeInfo,
+                                              response_json))
+    if 'CURRENT_FILES' in entry['url']:
+      yield 'uploaded files', _Size(_ChangeFiles(response_json))
+  elif endpoint == 'GET /changes/*/comments':
+    yield 'comments', _Size(libfetch.TrimToType(libsnapshot.CommentMapType,
+                                                response_json))
+
+
+def MeasurePayloads(path:str) -> typing.List[PayloadSavings]:
+  requests = collections.Counter()
+  recorded = collections.Counter()
+  trimmed = collections.Counter()
+  for entry in librecord.ReadFixture(path):
+    if entry['kind'] != 'fetch' or entry['status'] != 200:
+      continue
+    for payload, size in _Measure(entry):
+      requests[payload] += 1
+      recorded[payload] += len(entry['response'])
+      trimmed[payload] += size
+  return [PayloadSavings(payload, requests[payload], recorded[payload],
+                         trimmed[payload]) for payload in sorted(requests)]
+
+
+def RenderHtml(path:str, savings:typing.List[PayloadSavings]) -> str:
+  def Stream():
+    yield '<body class="pm_render">'
+    yield '<style>'
+    yield '.pm_render{font-family:monospace;padding:10px}'
+    yield '.pm_header{color:#947EB0}'
+    yield '</style>'
+    yield f'<h3>Payloads recorded in {path}</h3>'
+    if not savings:
+      yield '<div>No gerrit change or comment requests were recorded</div>'
+    else:
+      rows = [[s.payload, str(s.requests), str(s.recorded_bytes),
+               str(s.trimmed_bytes),
+               f'{100 - 100 * s.trimmed_bytes / s.recorded_bytes:.0f}%']
+              for s in savings]
+      yield from libmetrics.Table(
+        ['payload', 'requests', 'recorded', 'trimmed', 'saved'], rows)
+    yield '</body>'
+  return ''.join(Stream())
@@ -0,0 +1,260 @@
+import collections
+import sublime
+import sys
+import threading
+import time
+import types
+import typing
+
+from . import libmetrics
+
+
+DEFAULT_MEMORY_BUDGET_MB = 64
+# The budget is checked in the background after this many insertions.
+ENFORCE_EVERY = 256
+
+_MISSING = object()
+_NOT_WALKED = (type, types.ModuleType, types.FunctionType, types.MethodType,
+               types.BuiltinFunctionType)
+
+
+class CacheUsage(typing.NamedTuple):
+  name: str
+  entries: int
+  bytes: int
+  median_age: typing.Optional[float]
+  max_age: typing.Optional[float]
+  trimmable: bool
+
+
+class LruCache():
+  def __init__(self, name:str, max_entries:typing.Union[int, typing.Callable]):
+    self.name = name
+    self._max_entries = max_entries
+    self._entries:typing.Dict[typing.Any, tuple] = collections.OrderedDict()
+    self._lock = threading.Lock()
+    Enroll(self)
+
+  def _Limit(self) -> int:
+    if callable(self._max_entries):
+      return self._max_entries()
+    return self._max_entries
+
+  def Lookup(self, key) -> typing.Tuple[bool, typing.Any]:
+    with self._lock:
+      entry = self._entries.get(key, _MISSING)
+      if entry is not _MISSING:
+        self._entries.move_to_end(key)
+    if entry is _MISSING:
+      libmetrics.Cache(self.name).Miss()
+      return False, None
+    libmetrics.Cache(self.name).Hit()
+    return True, entry[1]
+
+  def Get(self, key, default=None):
+    found, value = self.Lookup(key)
+    return value if found else default
+
+  def Put(self, key, value):
+    with self._lock:
+      self._entries[key] = (time.monotonic(), value)
+      self._entries.move_to_end(key)
+      evicted = self._Shrink(self._Limit())
+    if evicted:
+      libmetrics.Cache(self.name).Evict(evicted)
+    _NoteInsertion()
+
+  def Pop(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def _Shrink(self, limit:int) -> int:
+    evicted = 0
+    while len(self._entries) > max(0, limit):
+      self._entries.popitem(last=False)
+      evicted += 1
+    return evicted
+
+  # Least recently used first.
+  def Evict(self, count:int) -> int:
+    with self._lock:
+      evicted = self._Shrink(len(self._entries) - count)
+    if evicted:
+      libmetrics.Cache(self.name).Evict(evicted)
+    return evicted
+
+  def Clear(self) -> int:
+    return self.Evict(len(self._entries))
+
+  def Entries(self) -> typing.List[typing.Tuple[typing.Optional[float], typing.Any]]:
+    with self._lock:
+      return [(stored_at, (key, value))
+              for key, (stored_at, value) in self._entries.items()]
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+
+# For caches which keep their own structure. `entries` returns (time stored,
+# entry) pairs, the time being None if it isn't known, and `evict` drops the
+# given number of the least valuable entries. Without `evict`, the cache is
+# only reported on.
+class _Enrolled():
+  def __init__(self, name:str, entries:typing.Callable,
+               evict:typing.Optional[typing.Callable]):
+    self.name = name
+    self.Entries = entries
+    self._evict = evict
+
+  def Evict(self, count:int) -> int:
+    return self._evict(count) if self._evict else 0
+
+
+_REGISTRY:typing.Dict[str, typing.Any] = {}
+_REGISTRY_LOCK = threading.Lock()
+_INSERTIONS = 0
+_ENFORCING = False
+
+
+def Enroll(cache):
+  with _REGISTRY_LOCK:
+    _REGISTRY[cache.name] = cache
+
+
+def EnrollCustom(name:str, entries:typing.Callable,
+                 evict:typing.Optional[typing.Callable]=None):
+  Enroll(_Enrolled(name, entries, evict))
+
+
+def _Trimmable(cache) -> bool:
+  return not isinstance(cache, _Enrolled) or cache._evict is not None
+
+
+def SizeOf(*values) -> int:
+  # An approximation: shared objects are only counted once per call, and
+  # anything which isn't a plain container or object is counted shallowly.
+  seen = set()
+  pending = list(values)
+  size = 0
+  while pending:
+    value = pending.pop()
+    if id(value) in seen or isinstance(value, _NOT_WALKED):
+      continue
+    seen.add(id(value))
+    size += sys.getsizeof(value, 0)
+    if isinstance(value, dict):
+      pending.extend(value.keys())
+      pending.extend(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset, collections.deque)):
+      pending.extend(value)
+    # Subclasses of containers, such as libgit.Gerrit, keep attributes too.
+    if hasattr(value, '__dict__'):
+      pending.append(vars(value))
+  return size
+
+
+def _Bytes(entries:typing.List[tuple]) -> int:
+  return SizeOf(*(entry for _, entry in entries))
+
+
+def _Usage(cache, now:float) -> CacheUsage:
+  entries = cache.Entries()
+  ages = sorted(now - stored_at for stored_at, _ in entries
+                if stored_at is not None)
+  return CacheUsage(
+    name=cache.name,
+    entries=len(entries),
+    bytes=_Bytes(entries),
+    median_age=ages[len(ages) // 2] if ages else None,
+    max_age=ages[-1] if ages else None,
+    trimmable=_Trimmable(cache))
+
+
+def Report() -> typing.List[CacheUsage]:
+  with _REGISTRY_LOCK:
+    caches = list(_REGISTRY.values())
+  now = time.monotonic()
+  return [_Usage(cache, now) for cache in sorted(caches, key=lambda c: c.name)]
+
+
+def Trim() -> int:
+  with _REGISTRY_LOCK:
+    caches = list(_REGISTRY.values())
+  return sum(cache.Evict(len(cache.Entries())) for cache in caches)
+
+
+def _Budget() -> int:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  budget = settings.get('cache_memory_budget_mb', DEFAULT_MEMORY_BUDGET_MB)
+  return int(budget * 1024 * 1024)
+
+
+def EnforceBudget() -> int:
+  budget = _Budget()
+  if not budget:
+    return 0
+  with _REGISTRY_LOCK:
+    caches = [cache for cache in _REGISTRY.values() if _Trimmable(cache)]
+  sizes = {cache.name: _Bytes(cache.Entries()) for cache in caches}
+  total = sum(sizes.values())
+  evicted = 0
+  while total > budget and caches:
+    # Take a quarter of the largest cache each round, oldest entries first.
+    largest = max(caches, key=lambda cache: sizes[cache.name])
+    count = len(largest.Entries())
+    dropped = largest.Evict(max(1, count // 4)) if count else 0
+    if not dropped:
+      caches.remove(largest)
+      continue
+    evicted += dropped
+    size = _Bytes(largest.Entries())
+    total -= sizes[largest.name] - size
+    sizes[largest.name] = size
+  return evicted
+
+
+def _EnforceInBackground():
+  global _ENFORCING
+  try:
+    EnforceBudget()
+  finally:
+    _ENFORCING = False
+
+
+def _NoteInsertion():
+  global _INSERTIONS, _ENFORCING
+  _INSERTIONS += 1
+  if _INSERTIONS % ENFORCE_EVERY or _ENFORCING:
+    return
+  _ENFORCING = True
+  sublime.set_timeout_async(_EnforceInBackground)
+
+
+def _Age(seconds:typing.Optional[float]) -> str:
+  if seconds is None:
+    return '-'
+  if seconds < 120:
+    return f'{seconds:.0f}s'
+  if seconds < 7200:
+    return f'{seconds / 60:.0f}m'
+  return f'{seconds / 3600:.1f}h'
+
+
+def RenderHtml() -> str:
+  usage = Report()
+  def Stream():
+    yield '<body class="pm_render">'
+    yield '<style>'
+    yield '.pm_render{font-family:monospace;padding:10px}'
+    yield '.pm_header{color:#947EB0}'
+    yield '</style>'
+    total = sum(u.bytes for u in usage)
+    yield (f'<h3>Caches: {total / 1024:.0f} KiB of a '
+           f'{_Budget() / 1024:.0f} KiB budget</h3>')
+    rows = [[u.name, str(u.entries), f'{u.bytes / 1024:.1f}',
+             _Age(u.median_age), _Age(u.max_age),
+             'yes' if u.trimmable else 'no'] for u in usage]
+    yield from libmetrics.Table(
+      ['cache', 'entries', 'KiB', 'median age', 'oldest', 'trimmable'], rows)
+    yield '</body>'
+  return ''.join(Stream())
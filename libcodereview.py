@@ -1,58 +1,74 @@
 
+import bisect
 import sublime
+import threading
 import typing
-from . import libfetch
+from . import libcaches
 from . import libgerrit
+from . import libhunks
+from . import libmetrics
+from . import librepo
+from . import libsnapshot
 from . import libtemplate
+from . import libthreads
+
+
+COMMENT_CHAIN_CSS = libtemplate.MinifyCss('''
+  .cr-widthfix {
+    margin:0 20px;
+    padding:4px;
+    color:#000;
+  }
+  .cr-message-entry {
+    border-bottom: 1px solid black;
+  }
+  .cr-control-link {
+    padding-right: 5px;
+  }
+  .cr-message-body {
+    border: 1px solid #333;
+    background-color: #eee;
+    margin-bottom: 4px;
+  }
+''')
+
+
+COMMENT_RENDER_TEMPLATE = libtemplate.MinifyHtml('''
+<div class="cr-message-entry">
+  <div class="cr-message-header">
+    <div class="cr-message-author">
+      {comment.author}
+    </div>
+    <div class="cr-message-date">
+      {comment.date}
+    </div>
+  </div>
+  <div class="cr-message-body">
+    {comment.content}
+  </div>
+</div>
+''')
 
 
-COMMENT_CHAIN_RENDER_TEMPLATE = '''
+# minihtml can't share a stylesheet between phantoms, so every phantom carries
+# its own copy. Width and color are set inline to keep that copy identical
+# and minimal for every chain.
+COMMENT_CHAIN_RENDER_TEMPLATE = libtemplate.MinifyHtml('''
 <body class="codereview-comment">
-  <style>
-    .cr-widthfix \\{
-      width:{context.width}px;
-      margin:0 20px;
-      padding:4px;
-      background-color:{color};
-      color:#000;
-    \\}
-    .cr-message-entry \\{
-      border-bottom: 1px solid black;
-    \\}
-    .cr-control-link \\{
-      padding-right: 5px;
-    \\}
-    .cr-message-body \\{
-      border: 1px solid #333;
-      background-color: #eee;
-      margin-bottom: 4px;
-    \\}
-  </style>
-  <div class="cr-message-entry-list cr-widthfix">
-    {/context.comment_chain.comments}
-      <div class="cr-message-entry">
-        <div class="cr-message-header">
-          <div class="cr-message-author">
-            {.author}
-          </div>
-          <div class="cr-message-date">
-            {.date}
-          </div>
-        </div>
-        <div class="cr-message-body">
-          {.content}
-        </div>
-      </div>
-    {/context.comment_chain.comments}
+  <style>{css}</style>
+  <div class="cr-message-entry-list cr-widthfix"
+       style="width:{width}px;background-color:{color};">
+    {entries}
   </div>
-  <div class="cr-controls cr-widthfix">
+  <div class="cr-controls cr-widthfix"
+       style="width:{width}px;background-color:{color};">
     {/controls}
       <a href="{.control_function}" class="cr-control-link">
         {.rendername}</a>
     {/controls}
   </div>
 </body>
-'''
+''')
 
 
 class Mut():
@@ -108,15 +124,51 @@ class CommentChainRenderContext(typing.NamedTuple):
   def CreatePhantom(self, renderset:sublime.PhantomSet, contexts):
     self.renderset.set_value(renderset)
     controls = _ComputeControls(self.comment_chain)
-    html = libtemplate.Render(COMMENT_CHAIN_RENDER_TEMPLATE,
-      context=self,
-      controls=controls,
-      color=_ComputeCommentColor(self.comment_chain))
+    html = _RenderChain(self.comment_chain, self.width, controls,
+                        _ComputeCommentColor(self.comment_chain))
     return sublime.Phantom(self.region, html, sublime.PhantomLayout.BLOCK,
                            on_navigate=_HandleControlsClick(
                             self, controls, contexts))
 
 
+# Rendered html for comments and whole chains, shared between every view. The
+# keys cover everything the html depends on, so an edited comment or a new
+# draft simply stops matching its old entries, which age out.
+_FRAGMENTS = libcaches.LruCache('libcodereview.fragments', 512)
+
+
+def _Memoized(key:tuple, build:typing.Callable):
+  found, value = _FRAGMENTS.Lookup(key)
+  if not found:
+    value = build()
+    _FRAGMENTS.Put(key, value)
+  return value
+
+
+def _CommentKey(comment) -> tuple:
+  if comment.upstream_message_id:
+    return (comment.upstream_message_id, comment.date)
+  # Drafts have no id, but are never edited in place either.
+  return (None, comment.author, comment.date, comment.content)
+
+
+def _RenderComment(comment) -> str:
+  return _Memoized(('comment',) + _CommentKey(comment), lambda:
+    libtemplate.Render(COMMENT_RENDER_TEMPLATE, comment=comment))
+
+
+def _RenderChain(chain, width:int, controls, color:str) -> str:
+  key = ('chain', tuple(_CommentKey(c) for c in chain.comments), width,
+         color, tuple(controls))
+  return _Memoized(key, lambda: libtemplate.Render(
+    COMMENT_CHAIN_RENDER_TEMPLATE,
+    css=COMMENT_CHAIN_CSS,
+    width=width,
+    color=color,
+    entries=''.join(_RenderComment(c) for c in chain.comments),
+    controls=controls))
+
+
 def _MostRecentUpstream(comments):
   for comment in comments[::-1]:
     if comment.upstream_message_id:
@@ -139,7 +191,7 @@ def _HandleControlsClick(context, controls, contexts):
         upstream = _MostRecentUpstream(context.comment_chain.comments)
         if href == 'done':
           _CreateDraftComment('Done', True, context)
-          RenderContexts(context.view, contexts)
+          RenderContexts(context.view, _RenderedContexts(context.view, contexts))
         else:
           print(href)
 
@@ -148,11 +200,181 @@ def _HandleControlsClick(context, controls, contexts):
   return OperationProcessor
 
 
+class _ViewRenderState(typing.NamedTuple):
+  phantom_set: sublime.PhantomSet
+  # Every context in the view ordered by line, with matching render keys.
+  contexts: typing.List[CommentChainRenderContext]
+  lines: typing.List[int]
+  keys: typing.List[tuple]
+  # Only the chains near the viewport have a phantom.
+  rendered: typing.Dict[tuple, tuple]
+
+
+# Keeps the phantom built for every chain in a view, so that re-rendering
+# only rebuilds the chains which actually changed.
+_VIEW_RENDER_STATE:typing.Dict[int, _ViewRenderState] = {}
+# Reported on, but never trimmed: the phantoms are on screen.
+libcaches.EnrollCustom('libcodereview.view_state', lambda: [
+  (None, state) for state in list(_VIEW_RENDER_STATE.values())])
+_WATCHED_VIEWS = set()
+# Views are rendered from scheduler workers and from sublime's async thread.
+_RENDER_LOCK = threading.RLock()
+
+DEFAULT_VIEWPORT_MARGIN = 100
+VIEWPORT_POLL_MS = 300
+RELAYOUT_DEBOUNCE_MS = 250
+
+# The width a relayout is scheduled for, and a token to cancel older ones.
+_PENDING_RELAYOUT:typing.Dict[int, typing.Tuple[int, object]] = {}
+
+
+def _RenderKey(context:CommentChainRenderContext) -> tuple:
+  chain = context.comment_chain
+  comments = tuple((c.upstream_message_id, c.date, c.content, c.unresolved)
+                   for c in chain.comments)
+  return (chain.chain_id, context.region.a, context.width, comments,
+          chain.marked_complete_upstream,
+          chain.marked_complete_downstream.value())
+
+
+def _RenderedContexts(view:sublime.View, fallback):
+  state = _VIEW_RENDER_STATE.get(view.id(), None)
+  return state.contexts if state else fallback
+
+
+def _MaterializedLines(view:sublime.View) -> (int, int):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  margin = settings.get('phantom_viewport_margin_lines', DEFAULT_VIEWPORT_MARGIN)
+  visible = view.visible_region()
+  first, _ = view.rowcol(visible.begin())
+  last, _ = view.rowcol(visible.end())
+  return first - margin, last + margin
+
+
+def _Materialize(view:sublime.View, state:_ViewRenderState):
+  first, last = _MaterializedLines(view)
+  begin = bisect.bisect_left(state.lines, first)
+  end = bisect.bisect_right(state.lines, last)
+  rendered = {}
+  for key, context in zip(state.keys[begin:end], state.contexts[begin:end]):
+    if key in state.rendered:
+      rendered[key] = state.rendered[key]
+    else:
+      rendered[key] = (context, context.CreatePhantom(state.phantom_set,
+                                                      state.contexts))
+  if rendered.keys() == state.rendered.keys():
+    return
+  state.rendered.clear()
+  state.rendered.update(rendered)
+  state.phantom_set.update([phantom for _, phantom in rendered.values()])
+
+
 def RenderContexts(view:sublime.View, ctxs:'list[CommentChainRenderContext]'):
-  ps_name = 'codereview_' + view.file_name().replace('/', '_')
-  phantom_set = sublime.PhantomSet(view, ps_name)
-  phantoms = [context.CreatePhantom(phantom_set, ctxs) for context in ctxs]
-  phantom_set.update(phantoms)
+  with _RENDER_LOCK, libmetrics.Timed('render', 'RenderContexts'):
+    _RenderContextsLocked(view, ctxs)
+
+
+def _RenderContextsLocked(view:sublime.View, ctxs):
+  state = _VIEW_RENDER_STATE.get(view.id(), None)
+  if state is None:
+    ps_name = 'codereview_' + view.file_name().replace('/', '_')
+    state = _ViewRenderState(sublime.PhantomSet(view, ps_name), [], [], [], {})
+    _VIEW_RENDER_STATE[view.id()] = state
+
+  # Swap unchanged chains for the context that was already rendered, since
+  # the existing phantom's click handler refers to that one.
+  known = dict(zip(state.keys, state.contexts))
+  ordered = sorted(ctxs, key=lambda context: view.rowcol(context.region.a)[0])
+  keys = [_RenderKey(context) for context in ordered]
+  state.contexts[:] = [known.get(key, ctx) for key, ctx in zip(keys, ordered)]
+  state.lines[:] = [view.rowcol(ctx.region.a)[0] for ctx in state.contexts]
+  state.keys[:] = keys
+  _Materialize(view, state)
+
+
+def RefreshViewport(view:sublime.View):
+  with _RENDER_LOCK:
+    state = _VIEW_RENDER_STATE.get(view.id(), None)
+    if state is not None:
+      with libmetrics.Timed('render', 'RefreshViewport'):
+        _Materialize(view, state)
+
+
+def _ViewWidth(view:sublime.View) -> int:
+  return int(view.viewport_extent()[0]) - 40
+
+
+def RelayoutIfResized(view:sublime.View):
+  state = _VIEW_RENDER_STATE.get(view.id(), None)
+  if state is None or not state.contexts:
+    return
+  width = _ViewWidth(view)
+  pending_width, _ = _PENDING_RELAYOUT.get(view.id(), (None, None))
+  if width == pending_width:
+    return
+  if width == state.contexts[0].width and pending_width is None:
+    return
+
+  # Dragging a split or toggling the sidebar resizes in bursts, only lay out
+  # once the width has settled.
+  token = object()
+  _PENDING_RELAYOUT[view.id()] = (width, token)
+  def Relayout():
+    if _PENDING_RELAYOUT.get(view.id(), (None, None))[1] is not token:
+      return
+    _PENDING_RELAYOUT.pop(view.id())
+    with _RENDER_LOCK:
+      state = _VIEW_RENDER_STATE.get(view.id(), None)
+      if not state or not state.contexts or state.contexts[0].width == width:
+        return
+      contexts = [context._replace(width=width) for context in state.contexts]
+      for context in contexts:
+        context.comment_chain.render_context.set_value(context)
+      RenderContexts(view, contexts)
+  sublime.set_timeout_async(Relayout, RELAYOUT_DEBOUNCE_MS)
+
+
+def WatchViewport(view:sublime.View):
+  # There is no scroll event, so poll the active view while it has comments.
+  if view.id() in _WATCHED_VIEWS:
+    return
+  _WATCHED_VIEWS.add(view.id())
+  def Poll():
+    window = view.window()
+    if (view.id() not in _VIEW_RENDER_STATE or window is None or
+        window.active_view() != view):
+      _WATCHED_VIEWS.discard(view.id())
+      return
+    RelayoutIfResized(view)
+    RefreshViewport(view)
+    sublime.set_timeout_async(Poll, VIEWPORT_POLL_MS)
+  Poll()
+
+
+def ForgetView(view:sublime.View):
+  with _RENDER_LOCK:
+    _VIEW_RENDER_STATE.pop(view.id(), None)
+  _PENDING_RELAYOUT.pop(view.id(), None)
+
+
+def RenderCommentsForView(view:sublime.View, project=None):
+  repository = librepo.ForPath(view.file_name())
+  if repository is None:
+    return
+  if project is None:
+    project = libgerrit.GerritProjectInfo.ForCheckout(repository.root)
+  stale = libsnapshot.Load(project.server, project.upstream_change_id)
+  if stale is not None:
+    RenderContexts(view, CreateCommentChainContextsForView(view, stale))
+  try:
+    fresh = libsnapshot.Revalidate(
+      project.server, project.upstream_change_id, stale)
+  except Exception as e:
+    # Whatever was rendered from the stale snapshot stays on screen.
+    sublime.status_message(f'Could not refresh comments: {e}')
+    return
+  if fresh is not stale:
+    RenderContexts(view, CreateCommentChainContextsForView(view, fresh))
 
 
 def _CreateDraftComment(content:str, resolved:bool, context):
@@ -172,14 +394,20 @@ def _CreateDraftComment(content:str, resolved:bool, context):
 
 
 
-def _CreateCommentFromUpstream(upstream):
-  # Do some processing on the message:
+def _ProcessMessage(message:str) -> (str, bool):
   suggestion = False
-  content = upstream.message
+  content = message
   if content.startswith('```suggestion') and content.endswith('```'):
     suggestion = True
     content = 'Suggested Edit:\n' + content[13:-3]
-  content = content.replace('\n', '<br />')
+  return content.replace('\n', '<br />'), suggestion
+
+
+def _CreateCommentFromUpstream(upstream):
+  # Do some processing on the message:
+  content, suggestion = _Memoized(
+    ('message', upstream.id, upstream.updated),
+    lambda: _ProcessMessage(upstream.message))
   return Comment(
     author=upstream.author.name,
     date=upstream.updated,
@@ -193,7 +421,6 @@ def _CreateCommentFromUpstream(upstream):
 
 
 def _CreateCommentChainFromComments(drafts, comments, id, current_revision):
-  drafts = [d for d in drafts if d.comment_chain.value() == id]
   marked_complete_upstream = not comments[-1].unresolved
   attached_to_latest_patchset = comments[-1].patch_set == current_revision
   marked_complete_downstream = bool(drafts and not drafts[-1].unresolved)
@@ -211,13 +438,13 @@ def _CreateCommentChainFromComments(drafts, comments, id, current_revision):
   return chain
 
 
-def _CreateContextFromChain(chain, view, project, change_info):
+def _CreateContextFromChain(chain, view, project, change_info, line):
   context = CommentChainRenderContext(
     project=project,
     comment_chain=chain,
     view=view,
-    width=int(view.viewport_extent()[0]) - 40,
-    region=_ComputeCommentRegion(chain, view),
+    width=_ViewWidth(view),
+    region=_ComputeCommentRegion(line, view),
     upstream_change_info=change_info,
     renderset=Mut(None))
   chain.render_context.set_value(context)
@@ -232,8 +459,8 @@ def _ComputeCommentColor(chain):
   return '#fef7e0'
 
 
-def _ComputeCommentRegion(chain, view):
-  text_point = view.text_point(chain.initial_message.line - 1, 0)
+def _ComputeCommentRegion(line, view):
+  text_point = view.text_point(line - 1, 0)
   return sublime.Region(text_point, text_point)
 
 
@@ -251,55 +478,53 @@ def _ComputeControls(chain):
   return controls
 
 
-def CreateCommentChainContextsForView(view:sublime.View):
-  settings = sublime.load_settings('Chromium.sublime-settings')
-  checkout = settings['chromium_checkout']
-  filename = view.file_name()
-  if filename.startswith(checkout):
-    filename = filename[len(checkout)+1:]
-  else:
+def CreateCommentChainContextsForView(view:sublime.View, snapshot=None):
+  repository = librepo.ForPath(view.file_name())
+  if repository is None:
     sublime.status_message('This file is not part of the gerrit checkout')
     return []
+  filename = view.file_name()[len(repository.root)+1:]
 
-  project = libgerrit.GerritProjectInfo.FromSettings(settings)
-  change_info = libfetch.FetchInstance(libgerrit.ChangeInfo,
-    server=project.server, change_id=project.upstream_change_id)
+  project = libgerrit.GerritProjectInfo.ForCheckout(repository.root)
+  if snapshot is None:
+    snapshot = libsnapshot.Revalidate(
+      project.server, project.upstream_change_id, None)
+  change_info = snapshot.ChangeInfo()
   patch_set = change_info.revisions[change_info.current_revision].number
   if change_info.total_comment_count == 0:
     sublime.status_message('This file has no upstream comments')
     return []
 
-  comment_map = libfetch.FetchInstanceMap(libgerrit.ChangeComment,
-    server=project.server, change_id=project.upstream_change_id)
-  if filename not in comment_map:
+  threads = libthreads.ThreadsForSnapshot(snapshot)
+  if filename not in threads:
     # TODO: find a good way to cache local draft comments as well, and join
     # those here in comment map before making this check
     sublime.status_message('This file has no upstream comments')
     return []
 
-  comment_id_map = {comment.id:comment for comment in comment_map[filename]}
-  comment_to_root_map = {}
-  root_to_remotes_map = {}
-  for comment in comment_map[filename]:
-    if comment.in_reply_to == None:
-      comment_to_root_map[comment.id] = comment.id
-      root_to_remotes_map[comment.id] = [comment]
-    else:
-      assert comment.in_reply_to in comment_to_root_map
-      comment_to_root_map[comment.id] = comment_to_root_map[comment.in_reply_to]
-      root_to_remotes_map[comment_to_root_map[comment.id]].append(comment)
+  drafts_by_chain = {}
+  for draft in _LoadPendingComments(project.upstream_change_id, view.file_name()):
+    drafts_by_chain.setdefault(draft.comment_chain.value(), []).append(draft)
+
+  # Comments are placed relative to the revision they were left on, so local
+  # edits and older patchsets don't leave them on the wrong line.
+  mapper = libhunks.LineMapper(
+    repository.root, project,
+    {r.number: sha for sha, r in change_info.revisions.items()},
+    filename, view.substr(sublime.Region(0, view.size())))
 
   contexts = []
-  local_pending_comments = list(_LoadPendingComments(
-    project.upstream_change_id, view.file_name()))
-  for root_id, comment_list in root_to_remotes_map.items():
-    comments = []
-    for comment in comment_list:
-      comments.append(_CreateCommentFromUpstream(comment))
+  for root_id, comment_list in threads[filename].items():
+    comments = [_CreateCommentFromUpstream(c) for c in comment_list]
     chain = _CreateCommentChainFromComments(
-      local_pending_comments, comments, root_id, patch_set)
-    if chain.attached_to_latest_patchset:
-      contexts.append(_CreateContextFromChain(chain, view, project, change_info))
+      drafts_by_chain.get(root_id, []), comments, root_id, patch_set)
+    line = mapper.Map(comment_list[0].patch_set, comment_list[0].line)
+    if line is None:
+      if not chain.attached_to_latest_patchset:
+        continue
+      line = chain.initial_message.line
+    contexts.append(
+      _CreateContextFromChain(chain, view, project, change_info, line))
 
   return contexts
 
@@ -322,6 +547,5 @@ def _SavePendingComment(change_id:int, filename:str, comment:Comment):
   if filename not in pending[change_id]:
     pending[change_id][filename] = []
   pending[change_id][filename].append(serialized)
-  # TODO: How will this ever get cleared out?
   settings.set('pending_responses', pending)
   sublime.save_settings('Chromium.sublime-settings')
@@ -1,34 +1,273 @@
 
+import base64
 import collections
+import http.client
 import json
+import os
+import random
+import socket
+import sublime
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
 import types
 import typing
 
+from . import libcaches
+from . import libmetrics
+from . import librecord
 
-def FetchInstance(typeclass:type, **kwargs) -> 'typeclass':
+
+# Seconds a single attempt may take, and the whole call including retries.
+ATTEMPT_TIMEOUT = 10
+CALL_DEADLINE = 30
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.25
+
+# A server is considered unhealthy after this many consecutive failed calls,
+# and is given another try once the cooldown has passed.
+BREAKER_THRESHOLD = 3
+BREAKER_COOLDOWN = 30
+
+LAST_KNOWN_SIZE = 256
+
+# Every request to a server takes a token, so gerrit sees one request rate no
+# matter how many checkouts and workers are busy.
+DEFAULT_REQUESTS_PER_SECOND = 5
+DEFAULT_REQUEST_BURST = 10
+
+
+class FetchError(Exception):
+  pass
+
+
+class CircuitOpenError(FetchError):
+  def __init__(self, server):
+    super().__init__(f'{server} is unhealthy, not sending requests')
+
+
+class _CircuitBreaker():
+  def __init__(self):
+    self._failures = 0
+    self._opened_at = None
+    self._lock = threading.Lock()
+
+  def Allow(self) -> bool:
+    with self._lock:
+      if self._opened_at is None:
+        return True
+      # Half open: let a probe through, a failure re-opens it right away.
+      return time.monotonic() - self._opened_at >= BREAKER_COOLDOWN
+
+  def RecordSuccess(self):
+    with self._lock:
+      self._failures = 0
+      self._opened_at = None
+
+  def RecordFailure(self):
+    with self._lock:
+      self._failures += 1
+      if self._failures >= BREAKER_THRESHOLD:
+        self._opened_at = time.monotonic()
+
+
+class _TokenBucket():
+  def __init__(self, rate:float, burst:int):
+    self._rate = rate
+    self._burst = burst
+    self._tokens = burst
+    self._updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  # Takes a token if there is one, otherwise says how long until there is.
+  def Take(self) -> float:
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self._burst,
+                         self._tokens + (now - self._updated) * self._rate)
+      self._updated = now
+      if self._tokens >= 1:
+        self._tokens -= 1
+        return 0
+      return (1 - self._tokens) / self._rate
+
+
+_BREAKERS:typing.Dict[str, _CircuitBreaker] = collections.defaultdict(
+  _CircuitBreaker)
+_BUCKETS:typing.Dict[str, _TokenBucket] = {}
+_BUCKETS_LOCK = threading.Lock()
+_LAST_KNOWN = libcaches.LruCache('libfetch.last_known', LAST_KNOWN_SIZE)
+
+
+def _Server(uri:str) -> str:
+  parsed = urllib.parse.urlsplit(uri)
+  return f'{parsed.scheme}://{parsed.netloc}'
+
+
+def _IsRetryable(error:Exception) -> bool:
+  if isinstance(error, urllib.error.HTTPError):
+    return error.code >= 500
+  return isinstance(error, (urllib.error.URLError, socket.timeout,
+                            ConnectionError, http.client.HTTPException))
+
+
+def _Bucket(server:str) -> _TokenBucket:
+  with _BUCKETS_LOCK:
+    if server not in _BUCKETS:
+      settings = sublime.load_settings('Chromium.sublime-settings')
+      _BUCKETS[server] = _TokenBucket(
+        settings.get('gerrit_requests_per_second', DEFAULT_REQUESTS_PER_SECOND),
+        settings.get('gerrit_request_burst', DEFAULT_REQUEST_BURST))
+    return _BUCKETS[server]
+
+
+def _Throttle(uri:str):
+  bucket = _Bucket(_Server(uri))
+  while True:
+    delay = bucket.Take()
+    if not delay:
+      return
+    time.sleep(delay)
+
+
+def _LastKnown(uri:str, error:Exception):
+  found, response_json = _LAST_KNOWN.Lookup(uri)
+  if not found:
+    raise error
+  print(f'serving last known data for {uri}: {error}')
+  return response_json
+
+
+def _Open(request:urllib.request.Request, timeout:float) -> bytes:
+  def Read():
+    with urllib.request.urlopen(request, timeout=timeout) as r:
+      return r.read()
+  # Replayed traffic never reaches the network, so it isn't throttled. The
+  # wait isn't part of the request's latency either.
+  if not librecord.IsReplaying():
+    _Throttle(request.full_url)
+  endpoint = libmetrics.Endpoint(request.get_method(), request.full_url)
+  with libmetrics.Timed('gerrit', endpoint):
+    return librecord.Fetch(request.get_method(), request.full_url,
+                           request.data, Read)
+
+
+def _DecodeJson(response:bytes):
+  # Gerrit prefixes every json response with `)]}'` and a newline.
+  return json.loads(response[5:])
+
+
+def _DecodeBase64(response:bytes) -> str:
+  return base64.b64decode(response).decode('utf-8', 'replace')
+
+
+def _Attempt(uri:str, timeout:float, decode:typing.Callable):
+  return decode(_Open(urllib.request.Request(uri), timeout))
+
+
+def FetchJson(uri:str, deadline:float=CALL_DEADLINE):
+  return _Fetch(uri, deadline, _DecodeJson)
+
+
+# File contents are served base64 encoded rather than as json.
+def FetchBase64(uri:str, deadline:float=CALL_DEADLINE) -> str:
+  return _Fetch(uri, deadline, _DecodeBase64)
+
+
+def _Fetch(uri:str, deadline:float, decode:typing.Callable):
+  breaker = _BREAKERS[_Server(uri)]
+  if not breaker.Allow():
+    return _LastKnown(uri, CircuitOpenError(_Server(uri)))
+
+  give_up_at = time.monotonic() + deadline
+  for attempt in range(MAX_ATTEMPTS):
+    remaining = give_up_at - time.monotonic()
+    try:
+      response_json = _Attempt(uri, min(ATTEMPT_TIMEOUT, remaining), decode)
+    except Exception as e:
+      if not _IsRetryable(e):
+        raise
+      error = e
+    else:
+      breaker.RecordSuccess()
+      _LAST_KNOWN.Put(uri, response_json)
+      return response_json
+    # Full jitter, so that views retrying together don't stay in lockstep.
+    backoff = random.uniform(0, BACKOFF_BASE * (2 ** attempt))
+    if attempt + 1 == MAX_ATTEMPTS or time.monotonic() + backoff >= give_up_at:
+      break
+    time.sleep(backoff)
+
+  breaker.RecordFailure()
+  return _LastKnown(uri, FetchError(f'{uri}: {error}'))
+
+
+def _GitCookies(host:str) -> typing.Optional[str]:
+  try:
+    with open(os.path.expanduser('~/.gitcookies')) as f:
+      lines = f.read().splitlines()
+  except OSError:
+    return None
+  cookies = []
+  for line in lines:
+    fields = line.split('\t')
+    if len(fields) != 7:
+      continue
+    domain = fields[0]
+    if domain.startswith('#HttpOnly_'):
+      domain = domain[len('#HttpOnly_'):]
+    if host == domain.lstrip('.') or (domain[0] == '.' and host.endswith(domain)):
+      cookies.append(f'{fields[5]}={fields[6]}')
+  return '; '.join(cookies) or None
+
+
+def PostJson(uri:str, body, deadline:float=CALL_DEADLINE):
+  # Posts are never retried, gerrit would happily apply them twice.
+  breaker = _BREAKERS[_Server(uri)]
+  if not breaker.Allow():
+    raise CircuitOpenError(_Server(uri))
+  request = urllib.request.Request(uri, data=json.dumps(body).encode(),
+    method='POST', headers={'Content-Type': 'application/json'})
+  cookie = _GitCookies(urllib.parse.urlsplit(uri).hostname)
+  if cookie:
+    request.add_header('Cookie', cookie)
+  try:
+    response = _Open(request, deadline)
+  except Exception as e:
+    if _IsRetryable(e):
+      breaker.RecordFailure()
+    raise
+  breaker.RecordSuccess()
+  return json.loads(response[5:]) if response else None
+
+
+def FetchInstanceJson(typeclass:type, **kwargs):
   if not hasattr(typeclass, 'GetUrlPattern'):
     raise ValueError(f'Cant fetch {typeclass}')
-  request_uri = typeclass.GetUrlPattern().format(**kwargs)
-  with urllib.request.urlopen(request_uri) as r:
-    response_json = json.loads(r.read()[5:])
+  return FetchJson(typeclass.GetUrlPattern().format(**kwargs))
+
+def InstanceFromJson(typeclass:type, response_json) -> 'typeclass':
   return _Json2Type(typeclass, response_json)
 
-def FetchInstanceMap(typeclass:type, **kwargs):
-  if not hasattr(typeclass, 'GetUrlPattern'):
-    raise ValueError(f'Cant fetch {typeclass}')
-  request_uri = typeclass.GetUrlPattern().format(**kwargs)
-  with urllib.request.urlopen(request_uri) as r:
-    response_json = json.loads(r.read()[5:])
+def InstanceMapFromJson(typeclass:type, response_json):
   return _Json2Type(typing.Mapping[str, typeclass], response_json)
 
+def FetchInstance(typeclass:type, **kwargs) -> 'typeclass':
+  return InstanceFromJson(typeclass, FetchInstanceJson(typeclass, **kwargs))
+
+def FetchInstanceMap(typeclass:type, **kwargs):
+  return InstanceMapFromJson(typeclass, FetchInstanceJson(typeclass, **kwargs))
 
-def _Json2Type(typeclass, json):
-  def strunder(key):
-    while key and key[0] == '_':
-      key = key[1:]
-    return key
 
+def _Strunder(key:str) -> str:
+  while key and key[0] == '_':
+    key = key[1:]
+  return key
+
+
+def _Json2Type(typeclass, json):
   #print(f'converting {json} to {typeclass}')
 
   if type(json) == list:
@@ -47,6 +286,25 @@ def _Json2Type(typeclass, json):
     return {k:_Json2Type(typeclass.__args__[1], v) for k,v in json.items()}
 
   hints = typing.get_type_hints(typeclass)
-  clean = {strunder(k):v for k,v in json.items()}
+  clean = {_Strunder(k):v for k,v in json.items()}
   values = {k:_Json2Type(hints[k],v) for k,v in clean.items() if k in hints}
   return typeclass(**values)
+
+
+# Drops everything _Json2Type would ignore, so that payloads are only kept
+# around with the fields the models declare.
+def TrimToType(typeclass, json):
+  if type(json) == list:
+    return [TrimToType(typeclass, each) for each in json]
+
+  if type(json) != dict:
+    return json
+
+  if type(typeclass) == typing._GenericAlias:
+    if typeclass.__origin__ == list:
+      return TrimToType(typeclass.__args__[0], json)
+    return {k:TrimToType(typeclass.__args__[1], v) for k,v in json.items()}
+
+  hints = typing.get_type_hints(typeclass)
+  return {k:TrimToType(hints[_Strunder(k)], v) for k,v in json.items()
+          if _Strunder(k) in hints}
@@ -19,6 +19,21 @@ class ChangeInfo(typing.NamedTuple):
   def GetUrlPattern():
     return '{server}/changes/{change_id}?o=CURRENT_REVISION'
 
+  @staticmethod
+  def GetAllRevisionsUrlPattern():
+    # Only needed to place comments left on older patchsets.
+    return '{server}/changes/{change_id}?o=ALL_REVISIONS'
+
+  @staticmethod
+  def GetProbeUrlPattern():
+    # No options: just enough to see whether anything changed (meta_rev_id).
+    return '{server}/changes/{change_id}'
+
+  @staticmethod
+  def GetQueryUrlPattern():
+    # Many changes in one request, without revisions or other options.
+    return '{server}/changes/?q={query}'
+
   id:str
   triplet_id:str
   project:str
@@ -76,7 +91,10 @@ class GerritProjectInfo(typing.NamedTuple):
 
   @staticmethod
   def FromSettings(settings):
-    checkout = settings['chromium_checkout']
+    return GerritProjectInfo.ForCheckout(settings['chromium_checkout'])
+
+  @staticmethod
+  def ForCheckout(checkout:str):
     branch = libgit.Branch.Current(checkout)
     return GerritProjectInfo(
       branch.gerritserver, branch.branchname, branch.gerritissue)
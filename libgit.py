@@ -1,22 +1,30 @@
 
-import json
+import os
 import sublime
 import typing
-import urllib
 
+from . import libcaches
+from . import libfetch
+from . import libmetrics
+from . import librepo
 from . import librun
 
 
 ALL_BRANCHES = 'git branch --format "%(refname:short)"'
 CURRENT_BRANCH = 'git symbolic-ref -q HEAD'
 DEFAULT_BRANCH = 'git symbolic-ref refs/remotes/origin/HEAD'
-GET_PROPERTY = 'git config --get branch.{}.{}'
 GET_PARENT = 'git rev-parse --abbrev-ref {}@{{u}}'
 DIFF_FILES = 'git diff --name-only {} {}'
 AHEAD_BEHIND = 'git rev-list --left-right {}...{} --count'
+UPSTREAM_MERGE_BASE = 'git merge-base {0} {0}@{{u}}'
+DIFF_NAME_STATUS = 'git diff --name-status {} {}'
+REV_PARSE = 'git rev-parse {}'
+DIFF_NUMSTAT = 'git diff --numstat -z --no-renames {}...{}'
+ALL_UPSTREAMS = 'git for-each-ref --format="%(refname:short) %(upstream:short)" refs/heads'
+ALL_SHAS = 'git for-each-ref --format="%(refname:short) %(objectname)" refs/heads refs/remotes'
 
 
-CRREV_DETAIL_URI = '{server}/changes/{issue}'
+CRREV_FILES_URI = '{server}/changes/{issue}/revisions/current/files'
 CRREV_COMMENTS_URI = '{server}/changes/{issue}/comments'
 
 
@@ -38,13 +46,7 @@ class Branch(typing.NamedTuple):
 
   @classmethod
   def Get(cls, branchname:str, directory:str) -> 'Branch':
-    if not hasattr(cls, '__cache'):
-      setattr(cls, '__cache', {})
-    cache = getattr(cls, '__cache')
-    cachekey = f'{cls.__name__}.{branchname}'
-    if cachekey not in cache:
-      cache[cachekey] = cls(branchname, directory)
-    return cache[cachekey]
+    return librepo.ForDirectory(directory).Branch(cls, branchname)
 
   @classmethod
   def GetAllNamedLocalBranches(cls, directory:str):
@@ -56,11 +58,12 @@ class Branch(typing.NamedTuple):
         pass
 
   def __getattr__(self, attr:str) -> str:
-    try:
-      return librun.OutputOrError(GET_PROPERTY.format(self.branchname, attr),
-                                  cwd=self.git_dir)
-    except:
+    if attr.startswith('__'):
       raise AttributeError(attr)
+    value = librepo.ForDirectory(self.git_dir).BranchConfig(self.branchname, attr)
+    if value is None:
+      raise AttributeError(attr)
+    return value
 
   def Children(self) -> typing.Iterator['Branch']:
     for child in Branch.GetAllNamedLocalBranches(self.git_dir):
@@ -95,11 +98,144 @@ class Branch(typing.NamedTuple):
     return librun.OutputOrError(DIFF_FILES.format(self.branchname, parent_name),
                                 cwd=self.git_dir).split('\n')
 
+  def LocalFileChanges(self) -> typing.Dict[str, str]:
+    merge_base = librun.OutputOrError(
+      UPSTREAM_MERGE_BASE.format(self.branchname), cwd=self.git_dir)
+    diff = librun.OutputOrError(
+      DIFF_NAME_STATUS.format(merge_base, self.branchname), cwd=self.git_dir)
+    changes = {}
+    for line in diff.split('\n'):
+      if line:
+        # Renames and copies list both paths; we only care about the new one.
+        status, *paths = line.split('\t')
+        changes[paths[-1]] = status[0]
+    return changes
+
+  def IsUploaded(self) -> bool:
+    try:
+      uploaded = getattr(self, 'last-upload-hash')
+    except AttributeError:
+      return False
+    local = librun.OutputOrError(REV_PARSE.format(self.branchname),
+                                 cwd=self.git_dir)
+    return uploaded == local
+
   def IsCurrent(self):
     cb = librun.OutputOrError('git branch --show-current', cwd=self.git_dir)
     return cb == self.branchname
 
 
+class FileStat(typing.NamedTuple):
+  path: str
+  # None for binary files.
+  added: typing.Optional[int]
+  deleted: typing.Optional[int]
+
+
+class BranchFacts(typing.NamedTuple):
+  parent: typing.Optional[str]
+  ahead: int
+  behind: int
+  files: typing.List[FileStat]
+
+
+# Diff stats by (parent sha, branch sha). A pair of commits always diffs the
+# same way, so entries never go stale.
+_FILE_STATS = libcaches.LruCache('libgit.file_stats', 1024)
+
+
+# With -z paths are never quoted, and each record ends in a NUL.
+def _ParseNumstat(output:str) -> typing.List[FileStat]:
+  stats = []
+  for record in output.split('\0'):
+    if record:
+      added, deleted, path = record.split('\t', 2)
+      stats.append(FileStat(
+        path, None if added == '-' else int(added),
+        None if deleted == '-' else int(deleted)))
+  return stats
+
+
+def _ParentName(result) -> typing.Optional[str]:
+  parent_name = result.stdout.strip()
+  if result.returncode or parent_name == 'heads/origin/main':
+    return None
+  return parent_name
+
+
+# Every local branch's parent (as Branch.Parent names it) from one git call.
+def AllBranchParents(directory:str) -> typing.Dict[str, typing.Optional[str]]:
+  parents = {}
+  for line in librun.OutputOrError(ALL_UPSTREAMS, cwd=directory).split('\n'):
+    branchname, _, upstream = line.partition(' ')
+    if branchname:
+      parents[branchname] = (
+        None if upstream in ('', 'origin/main', 'heads/origin/main')
+        else upstream)
+  return parents
+
+
+# Every local and remote branch's commit, from one git call.
+def AllBranchShas(directory:str) -> typing.Dict[str, str]:
+  shas = {}
+  for line in librun.OutputOrError(ALL_SHAS, cwd=directory).split('\n'):
+    branchname, _, sha = line.partition(' ')
+    if branchname and sha:
+      shas[branchname] = sha
+  return shas
+
+
+# The same answers as Branch.Parent and Branch.AheadBehindBranch, but with the
+# git queries for every branch running concurrently. Branches which can't be
+# resolved, or whose parent can't be, are left out.
+def GatherBranchFacts(branches:typing.List[Branch], directory:str,
+                      parents=None) -> typing.Dict[str, BranchFacts]:
+  if parents is None:
+    parents = librun.RunCommands([
+      (GET_PARENT.format(branch.branchname), directory) for branch in branches])
+    parents = [_ParentName(result) for result in parents]
+  else:
+    parents = [parents.get(branch.branchname, None) for branch in branches]
+  if not branches:
+    return {}
+  shas = AllBranchShas(directory)
+  resolved = []
+  for branch, parent in zip(branches, parents):
+    base = parent or 'main'
+    if branch.branchname in shas and base in shas:
+      resolved.append((branch, parent, base))
+  if not resolved:
+    return {}
+  branches, parents, bases = (list(column) for column in zip(*resolved))
+
+  # Every branch's changes since its parent come from one concurrent batch of
+  # diffs, skipping any edge whose commits were already diffed.
+  edges = [(shas[base], shas[branch.branchname])
+           for branch, base in zip(branches, bases)]
+  stats = {}
+  for edge in set(edges):
+    found, files = _FILE_STATS.Lookup(edge)
+    if found:
+      stats[edge] = files
+  missing = sorted(set(edges) - set(stats))
+  results = librun.RunCommands(
+    [(AHEAD_BEHIND.format(edge[1], edge[0]), directory) for edge in edges] +
+    [(DIFF_NUMSTAT.format(*edge), directory) for edge in missing])
+  counts, diffs = results[:len(branches)], results[len(branches):]
+  for edge, result in zip(missing, diffs):
+    if not result.returncode:
+      stats[edge] = _ParseNumstat(result.stdout)
+      _FILE_STATS.Put(edge, stats[edge])
+
+  facts = {}
+  for branch, parent, edge, result in zip(branches, parents, edges, counts):
+    if result.returncode or edge not in stats:
+      continue
+    ahead, behind = (int(v) for v in result.stdout.split())
+    facts[branch.branchname] = BranchFacts(parent, ahead, behind, stats[edge])
+  return facts
+
+
 class Comment(typing.NamedTuple):
   author: str
   date: str
@@ -132,21 +268,37 @@ class Gerrit(Branch):
     self._data_crrev_detail = None
 
   def _query(self):
-    if self._data_crrev_detail is None:
-      uri = CRREV_DETAIL_URI.format(server=self._server, issue=self._issue)
-      options = '&'.join([f'o={o}' for o in ('CURRENT_FILES', 'CURRENT_REVISION')])
-      uri = f'{uri}?{options}'
-      with urllib.request.urlopen(uri) as r:
-        self._data_crrev_detail = json.loads(r.read()[5:])
+    if self._data_crrev_detail is not None:
+      libmetrics.Cache('libgit.change_detail').Hit()
+    else:
+      libmetrics.Cache('libgit.change_detail').Miss()
+      self._data_crrev_detail = libfetch.FetchJson(
+        CRREV_FILES_URI.format(server=self._server, issue=self._issue))
     return self._data_crrev_detail
 
   def Flush(self):
     self._data_crrev_detail = None
 
   def FileChangeList(self):
-    query = self._query()
-    current_revision = query['revisions'][query['current_revision']]
-    return list(current_revision['files'].keys())
+    local = self.LocalFileChanges()
+    files = [file for file, status in local.items() if status != 'D']
+    if self.IsUploaded():
+      return files
+    # The uploaded patchset may touch files that the local branch no longer
+    # does. Those can still have comments, so open them too if possible.
+    try:
+      remote = self._UploadedFileChangeList()
+    except Exception as e:
+      print(f'could not cross-check file list with gerrit: {e}')
+      return files
+    for file in remote:
+      if file not in local and os.path.exists(os.path.join(self.git_dir, file)):
+        files.append(file)
+    return files
+
+  def _UploadedFileChangeList(self):
+    # Skip gerrit's magic files, like /COMMIT_MSG.
+    return [f for f in self._query() if not f.startswith('/')]
 
   def PatchSetTitle(self):
     return self.branchname
@@ -161,8 +313,7 @@ class Gerrit(Branch):
       return []
 
     uri = CRREV_COMMENTS_URI.format(server=self._server, issue=self._issue)
-    with urllib.request.urlopen(uri) as r:
-      comment_json = json.loads(r.read()[5:])
+    comment_json = libfetch.FetchJson(uri)
 
     if filename not in comment_json:
       sublime.status_message('filename not in comment list')
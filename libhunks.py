@@ -0,0 +1,130 @@
+import bisect
+import difflib
+import hashlib
+import shlex
+import sublime
+import typing
+import urllib.error
+import urllib.parse
+
+from . import libcaches
+from . import libfetch
+from . import libgerrit
+from . import librun
+
+
+SHOW_FILE = 'git show {}'
+FILE_CONTENT_URI = (
+  '{server}/changes/{change_id}/revisions/{revision}/files/{path}/content')
+
+_SOURCES = libcaches.LruCache('libhunks.sources', 16)
+_INDEXES = libcaches.LruCache('libhunks.indexes', 64)
+# Every patchset's commit, by change.
+_REVISIONS = libcaches.LruCache('libhunks.revisions', 16)
+
+
+class HunkIndex(typing.NamedTuple):
+  old_starts: typing.List[int]
+  # (old_start, old_end, new_start, new_end), zero based and end exclusive.
+  hunks: typing.List[typing.Tuple[int, int, int, int]]
+
+  # Lines are one based. Lines which were rewritten or removed land at the
+  # start of whatever replaced them.
+  def Map(self, line:int) -> int:
+    index = bisect.bisect_right(self.old_starts, line - 1) - 1
+    if index < 0:
+      return line
+    old_start, old_end, new_start, new_end = self.hunks[index]
+    if line - 1 < old_end:
+      return new_start + 1
+    return line + (new_end - old_end)
+
+
+def _BuildIndex(old:typing.List[str], new:typing.List[str]) -> HunkIndex:
+  matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+  hunks = [(i1, i2, j1, j2)
+           for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+  return HunkIndex([hunk[0] for hunk in hunks], hunks)
+
+
+def _RevisionLines(checkout:str, project, revision:str,
+                   path:str) -> typing.Optional[typing.List[str]]:
+  key = (checkout, revision, path)
+  found, lines = _SOURCES.Lookup(key)
+  if found:
+    return lines
+  try:
+    # Patchsets uploaded from this checkout are usually still around locally.
+    result = librun.RunCommand(
+      SHOW_FILE.format(shlex.quote(f'{revision}:{path}')), cwd=checkout)
+    if result.returncode:
+      text = libfetch.FetchBase64(FILE_CONTENT_URI.format(
+        server=project.server, change_id=project.upstream_change_id,
+        revision=revision, path=urllib.parse.quote(path, safe='')))
+    else:
+      text = result.stdout
+    lines = text.splitlines()
+  except urllib.error.HTTPError as e:
+    if e.code != 404:
+      sublime.status_message(f'Could not load {path} at {revision}: {e}')
+      return None
+    # The file isn't in that revision, which won't change.
+    lines = None
+  except Exception as e:
+    # Most likely the network, so it's asked for again on the next render.
+    sublime.status_message(f'Could not load {path} at {revision}: {e}')
+    return None
+  _SOURCES.Put(key, lines)
+  return lines
+
+
+# Full fetches of a change only carry its current revision, so the others are
+# only asked for once a comment on one of them needs placing.
+def _OlderRevision(project, patch_set:int) -> typing.Optional[str]:
+  key = (project.server, str(project.upstream_change_id))
+  found, revisions = _REVISIONS.Lookup(key)
+  if not found or patch_set not in revisions:
+    try:
+      change_json = libfetch.FetchJson(
+        libgerrit.ChangeInfo.GetAllRevisionsUrlPattern().format(
+          server=project.server, change_id=project.upstream_change_id))
+    except Exception as e:
+      sublime.status_message(f'Could not list patchsets: {e}')
+      return None
+    revisions = {revision['_number']: sha
+                 for sha, revision in change_json['revisions'].items()}
+    _REVISIONS.Put(key, revisions)
+  return revisions.get(patch_set, None)
+
+
+# Maps lines on any revision of one file onto the text currently in the
+# buffer. Indexes are cached per revision and buffer contents, so renders
+# which don't follow an edit never diff anything.
+class LineMapper():
+  def __init__(self, checkout:str, project, revisions:typing.Dict[int, str],
+               path:str, text:str):
+    self._checkout = checkout
+    self._project = project
+    self._revisions = revisions
+    self._path = path
+    self._text = text
+    self._digest = hashlib.sha1(text.encode()).hexdigest()
+
+  def _Index(self, revision:str) -> typing.Optional[HunkIndex]:
+    key = (self._checkout, self._path, revision, self._digest)
+    found, index = _INDEXES.Lookup(key)
+    if not found:
+      old = _RevisionLines(self._checkout, self._project, revision, self._path)
+      if old is None:
+        return None
+      index = _BuildIndex(old, self._text.splitlines())
+      _INDEXES.Put(key, index)
+    return index
+
+  # None when the commented revision can't be found.
+  def Map(self, patch_set:int, line:int) -> typing.Optional[int]:
+    revision = self._revisions.get(patch_set, None)
+    if revision is None:
+      revision = _OlderRevision(self._project, patch_set)
+    index = self._Index(revision) if revision is not None else None
+    return index.Map(line) if index is not None else None
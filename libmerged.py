@@ -0,0 +1,191 @@
+import typing
+import urllib.parse
+
+from . import libfetch
+from . import libgerrit
+from . import libgit
+from . import librun
+from . import libworktree
+
+
+CURRENT_BRANCH = 'git branch --show-current'
+DEFAULT_UPSTREAM = 'git symbolic-ref --short refs/remotes/origin/HEAD'
+CHERRY = 'git cherry {} {} {}'
+SET_UPSTREAM = 'git branch --set-upstream-to={} {}'
+DELETE_BRANCH = 'git branch -d {}'
+FORCE_DELETE_BRANCH = 'git branch -D {}'
+
+
+# Merged branches found by the most recent pass, keyed by checkout and then
+# by branch.
+_LAST_RESULTS:typing.Dict[str, typing.Dict[str, 'MergedBranch']] = {}
+
+
+class MergedBranch(typing.NamedTuple):
+  branchname: str
+  # 'landed' when every commit has a patch-id equivalent upstream, 'gerrit'
+  # when the change is merged even though the commits don't match.
+  reason: str
+
+  def Describe(self) -> str:
+    if self.reason == 'landed':
+      return 'Merged: every commit has landed upstream'
+    return 'Merged in gerrit, but not every commit landed upstream'
+
+
+def _DefaultUpstream(gitdir:str) -> str:
+  result = librun.RunCommand(DEFAULT_UPSTREAM, cwd=gitdir)
+  return result.stdout.strip() if not result.returncode else 'main'
+
+
+# Whether each branch's own commits (those since its parent) all have a
+# patch-id equivalent upstream, which catches CLs which landed through a
+# rebase or cherry-pick on the server. Branches without commits of their own
+# are never counted as landed.
+def _Landed(gitdir:str, upstream:str,
+            parents:typing.Dict[str, typing.Optional[str]]) -> typing.Set[str]:
+  branches = [branchname for branchname in parents if branchname != 'main']
+  results = librun.RunCommands([
+    (CHERRY.format(upstream, branchname, parents[branchname] or upstream),
+     gitdir) for branchname in branches])
+  landed = set()
+  for branchname, result in zip(branches, results):
+    commits = result.stdout.split('\n') if not result.returncode else []
+    commits = [commit for commit in commits if commit]
+    if commits and all(commit.startswith('-') for commit in commits):
+      landed.add(branchname)
+  return landed
+
+
+# One query per gerrit server, for every change with one of the local
+# branches. A merged change only means its branch is merged when nothing was
+# committed to the branch since it was last uploaded.
+def _MergedInGerrit(gitdir:str,
+                    branchnames:typing.Iterable[str]) -> typing.Set[str]:
+  branchnames = set(branchnames) - {'main'}
+  issues:typing.Dict[str, typing.Dict[str, libgit.Gerrit]] = {}
+  for branch in libgit.Gerrit.GetAllNamedLocalBranches(gitdir):
+    if branch._server and branch._issue and branch.branchname in branchnames:
+      issues.setdefault(branch._server, {})[str(branch._issue)] = branch
+  merged = set()
+  for server, branches in issues.items():
+    query = ' OR '.join(f'change:{issue}' for issue in sorted(branches))
+    try:
+      changes = libfetch.FetchJson(libgerrit.ChangeInfo.GetQueryUrlPattern(
+        ).format(server=server, query=urllib.parse.quote(query)))
+    except Exception as e:
+      print(f'could not query {server} for merged changes: {e}')
+      continue
+    for change in changes:
+      branch = branches.get(str(change['_number']), None)
+      if change['status'] == 'MERGED' and branch and branch.IsUploaded():
+        merged.add(branch.branchname)
+  return merged
+
+
+def _Merged(gitdir:str, upstream:str,
+            parents:typing.Dict[str, typing.Optional[str]],
+            branchnames:typing.Iterable[str]) -> typing.Dict[str, MergedBranch]:
+  branchnames = set(branchnames)
+  landed = _Landed(gitdir, upstream, {
+    branchname: parent for branchname, parent in parents.items()
+    if branchname in branchnames})
+  merged = {branchname: MergedBranch(branchname, 'landed')
+            for branchname in landed}
+  for branchname in _MergedInGerrit(gitdir, branchnames) - landed:
+    merged[branchname] = MergedBranch(branchname, 'gerrit')
+  return merged
+
+
+def FindMergedBranches(gitdir:str) -> typing.Dict[str, MergedBranch]:
+  parents = libgit.AllBranchParents(gitdir)
+  merged = _Merged(gitdir, _DefaultUpstream(gitdir), parents, parents)
+  _LAST_RESULTS[gitdir] = merged
+  return merged
+
+
+# Called whenever the branches change, since the results may no longer hold.
+def Forget(gitdir:str):
+  _LAST_RESULTS.pop(gitdir, None)
+
+
+def LastResult(gitdir:str, branchname:str) -> typing.Optional[MergedBranch]:
+  return _LAST_RESULTS.get(gitdir, {}).get(branchname, None)
+
+
+def LastResults(gitdir:str) -> typing.Dict[str, MergedBranch]:
+  return _LAST_RESULTS.get(gitdir, {})
+
+
+def LandedResults(gitdir:str) -> typing.Dict[str, MergedBranch]:
+  return {branchname: merged
+          for branchname, merged in LastResults(gitdir).items()
+          if merged.reason == 'landed'}
+
+
+# Deletes the branches which are still merged. Landed branches are first
+# rebased onto upstream, which drops the commits that landed, and then deleted
+# with `git branch -d`, so git refuses if anything is left. Branches only
+# merged in gerrit may hold commits which never landed, and are only deleted
+# when they're in `force`. Each child of a deleted branch is rebased onto the
+# nearest ancestor which is kept, and a branch is only deleted once all of its
+# children have moved off it. The checked out branch is never deleted, or
+# moved. Returns the branches which were deleted.
+def DeleteMergedBranches(gitdir:str, branchnames:typing.Iterable[str],
+                         workers:int=4,
+                         force:typing.Iterable[str]=()) -> typing.List[str]:
+  current = librun.OutputOrError(CURRENT_BRANCH, cwd=gitdir)
+  parents = libgit.AllBranchParents(gitdir)
+  upstream = _DefaultUpstream(gitdir)
+  # The branches may have moved on since they were found to be merged.
+  merged = _Merged(gitdir, upstream, parents, [
+    branchname for branchname in branchnames
+    if branchname in parents and branchname != current])
+  Forget(gitdir)
+  force = set(force)
+  # Every commit is read before anything moves, since parents move too.
+  shas = libgit.AllBranchShas(gitdir)
+  landed = {branchname for branchname, found in merged.items()
+            if found.reason == 'landed' and
+            (parents[branchname] or upstream) in shas}
+  doomed = landed | (set(merged) & force)
+  if not doomed:
+    return []
+
+  def Survivor(branchname:str) -> str:
+    parent = parents.get(branchname, None)
+    while parent in doomed:
+      parent = parents.get(parent, None)
+    return parent or upstream
+
+  children = [(branchname, Survivor(branchname), shas[parent])
+              for branchname, parent in parents.items()
+              if parent in doomed and branchname not in doomed]
+  results = libworktree.RebaseOnto(gitdir, children + [
+    (branchname, upstream, shas[parents[branchname] or upstream])
+    for branchname in sorted(landed)], workers)
+
+  reparents = []
+  for branchname in sorted(landed):
+    if results[branchname].status == 'rebased':
+      reparents.append(SET_UPSTREAM.format(upstream, branchname))
+    else:
+      doomed.discard(branchname)
+  for branchname, survivor, _ in children:
+    if results[branchname].status == 'rebased':
+      reparents.append(SET_UPSTREAM.format(survivor, branchname))
+      continue
+    # The child still holds its ancestors' commits, so they're kept.
+    parent = parents[branchname]
+    while parent in doomed:
+      doomed.discard(parent)
+      parent = parents.get(parent, None)
+  # One at a time, since each of these writes the git config.
+  for command in reparents:
+    librun.OutputOrError(command, cwd=gitdir)
+  deleted = []
+  for branchname in sorted(doomed):
+    delete = DELETE_BRANCH if branchname in landed else FORCE_DELETE_BRANCH
+    if not librun.RunCommand(delete.format(branchname), cwd=gitdir).returncode:
+      deleted.append(branchname)
+  return deleted
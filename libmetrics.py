@@ -0,0 +1,195 @@
+import collections
+import contextlib
+import html
+import re
+import time
+import typing
+import urllib.parse
+
+
+# Percentiles are taken over this many of the most recent samples.
+SAMPLE_WINDOW = 512
+
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-f]{20,}|.*~.*)$')
+_NAMED_BY_PARENT = ('changes', 'revisions', 'files')
+
+
+class HistogramSummary(typing.NamedTuple):
+  count: int
+  errors: int
+  mean: float
+  p50: float
+  p90: float
+  p99: float
+  max: float
+
+
+# Recording never takes a lock: the deque append is atomic, and the counters
+# are plain ints which may drop the odd increment if two threads race. That's
+# fine for diagnostics, and keeps the hot paths as cheap as possible.
+class Histogram():
+  def __init__(self):
+    self.count = 0
+    self.errors = 0
+    self._samples = collections.deque(maxlen=SAMPLE_WINDOW)
+
+  def Record(self, seconds:float, ok:bool=True):
+    self.count += 1
+    if not ok:
+      self.errors += 1
+    self._samples.append(seconds)
+
+  def Summary(self) -> HistogramSummary:
+    samples = sorted(self._samples)
+    if not samples:
+      return HistogramSummary(self.count, self.errors, 0, 0, 0, 0, 0)
+    def Percentile(p):
+      return samples[min(len(samples) - 1, int(p * len(samples)))]
+    return HistogramSummary(
+      self.count, self.errors, sum(samples) / len(samples),
+      Percentile(0.5), Percentile(0.9), Percentile(0.99), samples[-1])
+
+
+class CacheStats():
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def Hit(self):
+    self.hits += 1
+
+  def Miss(self):
+    self.misses += 1
+
+  def Evict(self, count:int=1):
+    self.evictions += count
+
+
+_HISTOGRAMS:typing.Dict[typing.Tuple[str, str], Histogram] = {}
+_CACHES:typing.Dict[str, CacheStats] = {}
+
+
+def GetHistogram(group:str, name:str) -> Histogram:
+  histogram = _HISTOGRAMS.get((group, name), None)
+  if histogram is None:
+    histogram = _HISTOGRAMS.setdefault((group, name), Histogram())
+  return histogram
+
+
+def Cache(name:str) -> CacheStats:
+  stats = _CACHES.get(name, None)
+  if stats is None:
+    stats = _CACHES.setdefault(name, CacheStats())
+  return stats
+
+
+@contextlib.contextmanager
+def Timed(group:str, name:str):
+  start = time.perf_counter()
+  ok = False
+  try:
+    yield
+    ok = True
+  finally:
+    GetHistogram(group, name).Record(time.perf_counter() - start, ok)
+
+
+def Endpoint(method:str, url:str) -> str:
+  # Changes, revisions and accounts are collapsed so a change's requests are
+  # grouped with everyone else's.
+  segments = urllib.parse.urlsplit(url).path.split('/')
+  for index, segment in enumerate(segments):
+    if segment and (_ID_SEGMENT.match(segment) or (
+        index and segments[index - 1] in _NAMED_BY_PARENT)):
+      segments[index] = '*'
+  return f'{method} {"/".join(segments)}'
+
+
+def GitSubcommand(command:str) -> str:
+  words = command.split()
+  if len(words) > 1 and words[0] == 'git':
+    return words[1]
+  return words[0] if words else ''
+
+
+def _Milliseconds(seconds:float) -> str:
+  return f'{seconds * 1000:.1f}'
+
+
+def _Row(cells:typing.List[str], widths:typing.List[int]) -> str:
+  text = ''.join(cell.ljust(width) for cell, width in zip(cells, widths))
+  return f'<div>{html.escape(text).replace(" ", "&nbsp;")}</div>'
+
+
+def Table(header:typing.List[str], rows:typing.List[typing.List[str]]):
+  widths = [max(len(row[i]) for row in [header] + rows) + 2
+            for i in range(len(header))]
+  yield f'<div class="pm_header">{_Row(header, widths)}</div>'
+  for row in rows:
+    yield _Row(row, widths)
+
+
+def _HistogramSection(title:str, group:str):
+  rows = []
+  histograms = [(name, h) for (g, name), h in list(_HISTOGRAMS.items())
+                if g == group]
+  for name, histogram in sorted(histograms):
+    summary = histogram.Summary()
+    rows.append([name, str(summary.count), str(summary.errors),
+                 _Milliseconds(summary.mean), _Milliseconds(summary.p50),
+                 _Milliseconds(summary.p90), _Milliseconds(summary.p99),
+                 _Milliseconds(summary.max)])
+  yield f'<h3>{title}</h3>'
+  if not rows:
+    yield '<div>Nothing recorded yet</div>'
+    return
+  yield from Table(
+    [group, 'count', 'errors', 'mean ms', 'p50', 'p90', 'p99', 'max'], rows)
+
+
+def _CacheSection():
+  rows = []
+  for name, stats in sorted(list(_CACHES.items())):
+    lookups = stats.hits + stats.misses
+    rate = f'{100 * stats.hits / lookups:.0f}%' if lookups else '-'
+    rows.append([name, str(stats.hits), str(stats.misses), rate,
+                 str(stats.evictions)])
+  yield '<h3>Caches</h3>'
+  if not rows:
+    yield '<div>Nothing recorded yet</div>'
+    return
+  yield from Table(['cache', 'hits', 'misses', 'hit rate', 'evictions'], rows)
+
+
+def _SchedulerSection(schedulers):
+  rows = []
+  for checkout, lanes in sorted(schedulers.items()):
+    for lane, stats in lanes.items():
+      rows.append([checkout, lane, str(stats.depth), str(stats.submitted),
+                   str(stats.deduplicated), str(stats.completed),
+                   str(stats.failed), _Milliseconds(stats.mean_wait),
+                   _Milliseconds(stats.max_wait)])
+  yield '<h3>Scheduler queues</h3>'
+  if not rows:
+    yield '<div>Nothing scheduled yet</div>'
+    return
+  yield from Table(['checkout', 'lane', 'depth', 'submitted', 'deduped',
+                    'completed', 'failed', 'mean wait ms', 'max wait'], rows)
+
+
+# `schedulers` holds the lane stats of each checkout's scheduler.
+def RenderHtml(schedulers=None) -> str:
+  def Stream():
+    yield '<body class="pm_render">'
+    yield '<style>'
+    yield '.pm_render{font-family:monospace;padding:10px}'
+    yield '.pm_header{color:#947EB0}'
+    yield '</style>'
+    yield from _HistogramSection('Gerrit requests', 'gerrit')
+    yield from _HistogramSection('Git commands', 'git')
+    yield from _HistogramSection('Comment rendering', 'render')
+    yield from _SchedulerSection(schedulers or {})
+    yield from _CacheSection()
+    yield '</body>'
+  return ''.join(Stream())
@@ -0,0 +1,81 @@
+import bisect
+import typing
+
+from . import libhunks
+from . import libthreads
+
+
+class UnresolvedThread(typing.NamedTuple):
+  filename: str
+  line: int
+  root_id: str
+  author: str
+  message: str
+
+
+class UnresolvedIndex(typing.NamedTuple):
+  threads: typing.List[UnresolvedThread]
+  positions: typing.List[typing.Tuple[str, int]]
+
+  def _Step(self, start:int, step:int, skip:typing.Set[str]):
+    for offset in range(len(self.threads)):
+      thread = self.threads[(start + offset * step) % len(self.threads)]
+      if thread.root_id not in skip:
+        return thread
+    return None
+
+  # `skip` holds the threads which local drafts have already resolved.
+  def Next(self, filename:str, line:int, skip=frozenset()):
+    start = bisect.bisect_right(self.positions, (filename, line))
+    return self._Step(start, 1, skip)
+
+  def Previous(self, filename:str, line:int, skip=frozenset()):
+    start = bisect.bisect_left(self.positions, (filename, line)) - 1
+    return self._Step(start, -1, skip)
+
+
+def _BuildIndex(threads:libthreads.ChangeThreads,
+                locate:typing.Callable) -> UnresolvedIndex:
+  unresolved = []
+  for filename, file_threads in threads.items():
+    if filename.startswith('/'):
+      # Patchset level comments and /COMMIT_MSG can't be opened.
+      continue
+    for root_id, thread in file_threads.items():
+      if thread[-1].unresolved:
+        line = locate(filename, thread[0].patch_set, thread[0].line)
+        unresolved.append(UnresolvedThread(
+          filename, max(line, 1), root_id, thread[-1].author.name,
+          thread[-1].message.split('\n')[0]))
+  unresolved.sort(key=lambda thread: (thread.filename, thread.line))
+  return UnresolvedIndex(
+    unresolved, [(thread.filename, thread.line) for thread in unresolved])
+
+
+# Threads are placed on the lines their phantoms are rendered on: mapped from
+# the revision they were left on onto the file as it is now. `text_of` gives
+# the current text of a file, or None if it can't be read.
+def IndexForSnapshot(snapshot, checkout:str, project,
+                     text_of:typing.Callable) -> UnresolvedIndex:
+  change_info = snapshot.ChangeInfo()
+  revisions = {r.number: sha for sha, r in change_info.revisions.items()}
+  mappers = {}
+  def Locate(filename:str, patch_set:int, line:int) -> int:
+    if filename not in mappers:
+      text = text_of(filename)
+      mappers[filename] = libhunks.LineMapper(
+        checkout, project, revisions, filename, text) if text is not None else None
+    mapper = mappers[filename]
+    mapped = mapper.Map(patch_set, line) if mapper is not None else None
+    return line if mapped is None else mapped
+  # The threads and hunk indexes are cached, so building is cheap, and
+  # buffers change too often for the result to be worth keeping.
+  return _BuildIndex(libthreads.ThreadsForSnapshot(snapshot), Locate)
+
+
+def LocallyResolvedThreads(pending_responses:dict, change_id) -> typing.Set[str]:
+  latest = {}
+  for drafts in pending_responses.get(change_id, {}).values():
+    for draft in drafts:
+      latest[draft['comment_chain']] = draft
+  return {chain for chain, draft in latest.items() if not draft['unresolved']}
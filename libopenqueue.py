@@ -0,0 +1,98 @@
+import os
+import sublime
+import threading
+import typing
+
+from . import librepo
+from . import libscheduler
+from . import libsnapshot
+from . import libthreads
+
+
+# Ids of the views opened in the background, which only get their comments
+# rendered once the user activates them. Opening a file activates it too, so
+# activations while a batch opens, or of views which aren't in front once it
+# has, don't count.
+_DEFERRED:typing.Set[int] = set()
+_OPENING = 0
+_LOCK = threading.Lock()
+
+
+def IsDeferred(view:sublime.View) -> bool:
+  with _LOCK:
+    return view.id() in _DEFERRED
+
+
+# Whether the view was deferred and should be rendered now that it's active.
+def Release(view:sublime.View) -> bool:
+  with _LOCK:
+    if _OPENING or view.id() not in _DEFERRED:
+      return False
+    window = view.window()
+    if window is None or window.active_view() != view:
+      return False
+    _DEFERRED.discard(view.id())
+    return True
+
+
+def Forget(view:sublime.View):
+  with _LOCK:
+    _DEFERRED.discard(view.id())
+
+
+def PrioritizeFiles(files:typing.List[str], project) -> typing.List[str]:
+  server, change_id = project.server, project.upstream_change_id
+  try:
+    snapshot = libsnapshot.Revalidate(server, change_id,
+                                      libsnapshot.Load(server, change_id))
+  except Exception as e:
+    print(f'could not prioritize changed files: {e}')
+    return files
+  counts = libthreads.UnresolvedThreadCounts(
+    libthreads.ThreadsForSnapshot(snapshot))
+  # sorted() is stable, so files with equal counts keep the diff order.
+  return sorted(files, key=lambda file: -counts.get(file, 0))
+
+
+class OpenQueue():
+  def __init__(self, window:sublime.Window, checkout:str,
+               files:typing.List[str], batch_size:int, delay_ms:int):
+    self._window = window
+    self._checkout = checkout
+    self._files = list(files)
+    self._batch_size = max(1, batch_size)
+    self._delay_ms = delay_ms
+    self._foreground = None
+
+  def Start(self, project=None):
+    def Prioritize():
+      if project is not None:
+        self._files = PrioritizeFiles(self._files, project)
+      sublime.set_timeout(self._OpenBatch)
+    librepo.Get(self._checkout).Submit(libscheduler.INTERACTIVE, Prioritize)
+
+  def _OpenBatch(self):
+    global _OPENING
+    batch = self._files[:self._batch_size]
+    self._files = self._files[self._batch_size:]
+    with _LOCK:
+      _OPENING += 1
+    try:
+      for file in batch:
+        path = os.path.join(self._checkout, file)
+        # Files which are already open have their comments rendered.
+        existing = self._window.find_open_file(path)
+        view = existing or self._window.open_file(path)
+        if self._foreground is None:
+          self._foreground = view
+        elif existing is None:
+          with _LOCK:
+            _DEFERRED.add(view.id())
+      if self._foreground is not None:
+        # Opening a file focuses it, keep the most important one in front.
+        self._window.focus_view(self._foreground)
+    finally:
+      with _LOCK:
+        _OPENING -= 1
+    if self._files:
+      sublime.set_timeout(self._OpenBatch, self._delay_ms)
@@ -0,0 +1,205 @@
+import sublime
+import threading
+import time
+import typing
+import urllib.parse
+
+from . import libcodereview
+from . import libfetch
+from . import libgerrit
+from . import libgit
+from . import libprefetch
+from . import librepo
+from . import libscheduler
+from . import libsnapshot
+
+
+DEFAULT_INTERVAL_SECONDS = 60
+DEFAULT_MAX_INTERVAL_SECONDS = 900
+
+
+# The version of every change last seen by a poll, by (server, change number).
+_SEEN:typing.Dict[typing.Tuple[str, str], str] = {}
+_LOCK = threading.Lock()
+_STARTED = False
+_GENERATION = 0
+_INTERVAL = 0.0
+_LAST_POLL = 0.0
+_LAST_ACTIVITY = 0.0
+# The (interval, longest interval) settings. Activity is noted on every
+# keystroke, so they're only read again when the settings change.
+_INTERVALS:typing.Optional[typing.Tuple[float, float]] = None
+
+
+def _ReadSettings():
+  global _INTERVALS
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  interval = settings.get('poll_interval_seconds', DEFAULT_INTERVAL_SECONDS)
+  longest = settings.get('poll_max_interval_seconds',
+                         DEFAULT_MAX_INTERVAL_SECONDS)
+  _INTERVALS = interval, max(interval, longest)
+
+
+def _Settings() -> typing.Tuple[float, float]:
+  if _INTERVALS is None:
+    sublime.load_settings('Chromium.sublime-settings').add_on_change(
+      'libpoller', _ReadSettings)
+    _ReadSettings()
+  return _INTERVALS
+
+
+def _Stack() -> typing.Dict[str, typing.Dict[str, typing.List[libgit.Gerrit]]]:
+  stack = {}
+  for checkout in librepo.Checkouts():
+    try:
+      branches = list(libgit.Gerrit.GetAllNamedLocalBranches(checkout))
+    except Exception as e:
+      print(f'could not list branches in {checkout}: {e}')
+      continue
+    for branch in branches:
+      if branch._server and branch._issue:
+        stack.setdefault(branch._server, {}).setdefault(
+          str(branch._issue), []).append(branch)
+  return stack
+
+
+def _Versions(server:str, issues:typing.Iterable[str]) -> typing.Dict[str, str]:
+  query = ' OR '.join(f'change:{issue}' for issue in sorted(issues))
+  changes = libfetch.FetchJson(libgerrit.ChangeInfo.GetQueryUrlPattern().format(
+    server=server, query=urllib.parse.quote(query)))
+  return {str(change['_number']): libsnapshot.ChangeVersion(change)
+          for change in changes}
+
+
+def _HasChanged(server:str, issue:str, version:str) -> bool:
+  with _LOCK:
+    previous = _SEEN.get((server, issue), None)
+    _SEEN[(server, issue)] = version
+  if previous is not None:
+    return previous != version
+  # First sighting: only a cached snapshot can tell us it is out of date.
+  snapshot = libsnapshot.Load(server, issue)
+  return snapshot is not None and snapshot.Version() not in (None, version)
+
+
+def _OpenViews(changed:typing.Set[typing.Tuple[str, str]]):
+  projects = {}
+  for window in sublime.windows():
+    for view in window.views():
+      repository = librepo.ForPath(view.file_name())
+      if repository is None:
+        continue
+      if repository.root not in projects:
+        try:
+          projects[repository.root] = libgerrit.GerritProjectInfo.ForCheckout(
+            repository.root)
+        except Exception:
+          projects[repository.root] = None
+      project = projects[repository.root]
+      if project and (project.server, str(project.upstream_change_id)) in changed:
+        yield repository, project, view
+
+
+def _Refresh(changed:typing.Dict[typing.Tuple[str, str], typing.List[libgit.Gerrit]]):
+  for server, issue in changed:
+    libsnapshot.Expire(server, issue)
+  for repository, project, view in _OpenViews(set(changed)):
+    repository.Submit(
+      libscheduler.VISIBLE,
+      lambda view=view, project=project:
+        libcodereview.RenderCommentsForView(view, project),
+      key=('render', view.id()))
+  # Changes without an open view are refreshed in the background, so that
+  # opening one later is instant.
+  libprefetch.PrefetchBranches(
+    branch for branches in changed.values() for branch in branches)
+  sublime.status_message(f'New gerrit activity on {len(changed)} changes')
+
+
+def Poll() -> int:
+  changed = {}
+  for server, issues in _Stack().items():
+    try:
+      versions = _Versions(server, issues)
+    except Exception as e:
+      print(f'could not poll {server}: {e}')
+      continue
+    for issue, version in versions.items():
+      if issue in issues and _HasChanged(server, issue, version):
+        changed[(server, issue)] = issues[issue]
+  if changed:
+    _Refresh(changed)
+  return len(changed)
+
+
+def _Schedule(seconds:float):
+  global _GENERATION
+  with _LOCK:
+    _GENERATION += 1
+    generation = _GENERATION
+  sublime.set_timeout_async(lambda: _Tick(generation), int(seconds * 1000))
+
+
+def _Tick(generation:int):
+  with _LOCK:
+    if generation != _GENERATION:
+      return
+  checkouts = librepo.Checkouts()
+  if not checkouts:
+    return
+  librepo.Get(checkouts[0]).Submit(libscheduler.PREFETCH, _PollAndReschedule,
+                                   key=('poll',))
+
+
+def _PollAndReschedule():
+  global _STARTED, _INTERVAL, _LAST_POLL
+  started = time.monotonic()
+  try:
+    found = Poll()
+  except Exception as e:
+    print(f'polling gerrit failed: {e}')
+    found = 0
+  interval, longest = _Settings()
+  with _LOCK:
+    if interval <= 0:
+      # Polling was turned off since the last poll. Activity starts it again
+      # if it's turned back on.
+      _STARTED = False
+      return
+    active = _LAST_ACTIVITY >= _LAST_POLL
+    _LAST_POLL = started
+    if found or active:
+      _INTERVAL = interval
+    else:
+      # Nobody is looking, so there's no hurry to find out.
+      _INTERVAL = min(_INTERVAL * 2, longest)
+    next_poll = _INTERVAL
+  _Schedule(next_poll)
+
+
+def Start():
+  global _STARTED, _INTERVAL
+  interval, _ = _Settings()
+  with _LOCK:
+    if _STARTED or interval <= 0:
+      return
+    _STARTED = True
+    _INTERVAL = interval
+  _Schedule(interval)
+
+
+# Called on editor activity. Polling picks back up to its normal pace right
+# away rather than after the current backed off wait.
+def NoteActivity():
+  global _LAST_ACTIVITY, _INTERVAL
+  Start()
+  interval, _ = _Settings()
+  now = time.monotonic()
+  with _LOCK:
+    _LAST_ACTIVITY = now
+    backed_off = _STARTED and _INTERVAL > interval
+    if backed_off:
+      _INTERVAL = interval
+      due_in = max(0, interval - (now - _LAST_POLL))
+  if backed_off:
+    _Schedule(due_in)
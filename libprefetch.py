@@ -0,0 +1,35 @@
+import sublime
+import typing
+
+from . import libgit
+from . import librepo
+from . import libscheduler
+from . import libsnapshot
+from . import libthreads
+
+
+DEFAULT_MAX_CHANGES = 20
+
+
+def _Warm(server:str, change_id:str):
+  snapshot = libsnapshot.Revalidate(
+    server, change_id, libsnapshot.Load(server, change_id))
+  libthreads.ThreadsForSnapshot(snapshot)
+
+
+def PrefetchBranches(branches:typing.Iterable[libgit.Gerrit]):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  budget = settings.get('prefetch_max_changes', DEFAULT_MAX_CHANGES)
+  seen = set()
+  for branch in branches:
+    change = (branch._server, branch._issue)
+    if not all(change) or change in seen:
+      continue
+    if len(seen) >= budget:
+      break
+    seen.add(change)
+    server, issue = change
+    librepo.Get(branch.git_dir).Submit(
+      libscheduler.PREFETCH,
+      lambda server=server, issue=issue: _Warm(server, issue),
+      key=('prefetch', server, issue))
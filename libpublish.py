@@ -0,0 +1,67 @@
+import os
+import sublime
+import typing
+
+from . import libfetch
+from . import libsnapshot
+from . import libthreads
+
+
+REVIEW_URI = '{server}/a/changes/{change_id}/revisions/current/review'
+
+
+def _GatherDrafts(project, checkout:str, pending:dict):
+  snapshot = libsnapshot.Load(project.server, project.upstream_change_id)
+  newest = {}
+  if snapshot is not None:
+    for file_threads in libthreads.ThreadsForSnapshot(snapshot).values():
+      for root_id, thread in file_threads.items():
+        newest[root_id] = thread[-1].id
+  comments = {}
+  for filename, drafts in pending.items():
+    # Only the most recent draft on each thread reflects what the user wants.
+    latest = {}
+    for draft in drafts:
+      latest[draft['comment_chain']] = draft
+    path = os.path.relpath(filename, checkout)
+    comments[path] = [{
+      'in_reply_to': newest.get(chain_id, chain_id),
+      'message': draft['content'],
+      'unresolved': draft['unresolved'],
+      'line': draft['line'],
+    } for chain_id, draft in latest.items()]
+  return comments
+
+
+def _ClearPublished(change_id:str, published:dict):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  pending = settings['pending_responses']
+  remaining = pending.get(change_id, {})
+  # Drafts written while the request was in flight weren't sent, keep them.
+  for filename, drafts in published.items():
+    for draft in drafts:
+      if draft in remaining.get(filename, []):
+        remaining[filename].remove(draft)
+    if not remaining.get(filename, True):
+      remaining.pop(filename)
+  if remaining:
+    pending[change_id] = remaining
+  else:
+    pending.pop(change_id, None)
+  settings.set('pending_responses', pending)
+  sublime.save_settings('Chromium.sublime-settings')
+
+
+def PublishDrafts(project, checkout:str) -> typing.List[str]:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  change_id = project.upstream_change_id
+  pending = settings['pending_responses'].get(change_id, {})
+  comments = _GatherDrafts(project, checkout, pending)
+  if not comments:
+    return []
+  libfetch.PostJson(
+    REVIEW_URI.format(server=project.server, change_id=change_id),
+    {'comments': comments})
+  _ClearPublished(change_id, pending)
+  libsnapshot.Expire(project.server, change_id)
+  return list(pending.keys())
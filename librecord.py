@@ -0,0 +1,161 @@
+import asyncio
+import collections
+import json
+import subprocess
+import threading
+import time
+import typing
+import urllib.error
+
+
+class ReplayMissError(ValueError):
+  def __init__(self, kind, key):
+    super().__init__(f'no recorded {kind} for {key}')
+
+
+class _Recorder():
+  def __init__(self, path:str):
+    self._file = open(path, 'w')
+    self._lock = threading.Lock()
+
+  def Write(self, entry:dict):
+    with self._lock:
+      self._file.write(json.dumps(entry) + '\n')
+      self._file.flush()
+
+  def Close(self):
+    with self._lock:
+      self._file.close()
+
+
+class _Replayer():
+  def __init__(self, path:str, latency_scale:float):
+    self._latency_scale = latency_scale
+    self._lock = threading.Lock()
+    # Identical requests are answered in recorded order, and the last answer
+    # is repeated once they run out.
+    self._entries = collections.defaultdict(collections.deque)
+    self._last = {}
+    for entry in ReadFixture(path):
+      self._entries[_Key(entry)].append(entry)
+
+  def Take(self, key:tuple) -> dict:
+    with self._lock:
+      if self._entries.get(key, None):
+        self._last[key] = self._entries[key].popleft()
+      if key not in self._last:
+        raise ReplayMissError(key[0], key[1:])
+      return self._last[key]
+
+  def Delay(self, entry:dict) -> float:
+    return entry['duration'] * self._latency_scale
+
+  def Close(self):
+    pass
+
+
+_BACKEND:typing.Union[_Recorder, _Replayer, None] = None
+
+
+def ReadFixture(path:str) -> typing.List[dict]:
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def _Key(entry:dict) -> tuple:
+  if entry['kind'] == 'command':
+    return ('command', entry['command'], entry['cwd'])
+  return ('fetch', entry['method'], entry['url'], entry['body'])
+
+
+def StartRecording(path:str):
+  global _BACKEND
+  Stop()
+  _BACKEND = _Recorder(path)
+
+
+# latency_scale=0 replays instantly, 1 with the recorded latency.
+def StartReplay(path:str, latency_scale:float=0):
+  global _BACKEND
+  Stop()
+  _BACKEND = _Replayer(path, latency_scale)
+
+
+def Stop():
+  global _BACKEND
+  if _BACKEND is not None:
+    _BACKEND.Close()
+  _BACKEND = None
+
+
+def IsReplaying() -> bool:
+  return isinstance(_BACKEND, _Replayer)
+
+
+def _ReplayedCommand(command:str, entry:dict):
+  return subprocess.CompletedProcess(
+    command, entry['returncode'], entry['stdout'], entry['stderr'])
+
+
+def _RecordCommand(backend, command:str, cwd:str, result, start:float):
+  if isinstance(backend, _Recorder):
+    backend.Write({
+      'kind': 'command', 'command': command, 'cwd': cwd,
+      'returncode': result.returncode, 'stdout': result.stdout,
+      'stderr': result.stderr, 'duration': time.monotonic() - start})
+
+
+def RunCommand(command:str, cwd:str, run:typing.Callable):
+  backend = _BACKEND
+  if isinstance(backend, _Replayer):
+    entry = backend.Take(('command', command, cwd))
+    time.sleep(backend.Delay(entry))
+    return _ReplayedCommand(command, entry)
+  start = time.monotonic()
+  result = run()
+  _RecordCommand(backend, command, cwd, result, start)
+  return result
+
+
+async def RunCommandAsync(command:str, cwd:str, run:typing.Callable):
+  backend = _BACKEND
+  if isinstance(backend, _Replayer):
+    entry = backend.Take(('command', command, cwd))
+    await asyncio.sleep(backend.Delay(entry))
+    return _ReplayedCommand(command, entry)
+  start = time.monotonic()
+  result = await run()
+  _RecordCommand(backend, command, cwd, result, start)
+  return result
+
+
+def Fetch(method:str, url:str, body:typing.Optional[bytes],
+          fetch:typing.Callable) -> bytes:
+  backend = _BACKEND
+  body = body.decode() if body else None
+  if isinstance(backend, _Replayer):
+    entry = backend.Take(('fetch', method, url, body))
+    time.sleep(backend.Delay(entry))
+    if entry['status'] is None:
+      raise urllib.error.URLError(entry['error'])
+    if entry['status'] >= 400:
+      raise urllib.error.HTTPError(url, entry['status'], entry['error'],
+                                   None, None)
+    return entry['response'].encode()
+
+  start = time.monotonic()
+  entry = {'kind': 'fetch', 'method': method, 'url': url, 'body': body}
+  try:
+    response = fetch()
+    entry.update(status=200, response=response.decode(), error=None)
+    return response
+  except urllib.error.HTTPError as e:
+    entry.update(status=e.code, response=None, error=str(e.reason))
+    raise
+  except Exception as e:
+    entry.update(status=None, response=None, error=str(e))
+    raise
+  finally:
+    if isinstance(backend, _Recorder):
+      entry['duration'] = time.monotonic() - start
+      backend.Write(entry)
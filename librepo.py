@@ -0,0 +1,216 @@
+import os
+import sublime
+import threading
+import time
+import typing
+
+from . import libcaches
+from . import libmetrics
+from . import libscheduler
+from . import librun
+
+
+BRANCH_CONFIG = "git config -z --get-regexp '^branch\\.'"
+COMMON_DIR = 'git rev-parse --git-common-dir'
+
+
+class Repository():
+  def __init__(self, root:str):
+    self.root = root
+    self._lock = threading.Lock()
+    self._config_file = None
+    self._config_stamp = None
+    self._config:typing.Dict[str, str] = {}
+    # (cls name, branch name) => (time cached, branch).
+    self._branches:typing.Dict[tuple, tuple] = {}
+    self._scheduler = None
+
+  def _ConfigFile(self) -> str:
+    if self._config_file is None:
+      common = librun.OutputOrError(COMMON_DIR, cwd=self.root)
+      self._config_file = os.path.join(self.root, common, 'config')
+    return self._config_file
+
+  def _Refresh(self):
+    # Called with the lock held. Anything which rewrites the git config (like
+    # `git cl upload` or a new branch) drops every cached branch as well.
+    try:
+      stat = os.stat(self._ConfigFile())
+      stamp = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+      stamp = None
+    if stamp is not None and stamp == self._config_stamp:
+      libmetrics.Cache('librepo.config').Hit()
+      return
+    libmetrics.Cache('librepo.config').Miss()
+    libmetrics.Cache('librepo.branches').Evict(len(self._branches))
+    result = librun.RunCommand(BRANCH_CONFIG, cwd=self.root)
+    config = {}
+    for entry in result.stdout.split('\0'):
+      key, _, value = entry.partition('\n')
+      if key:
+        config[key] = value
+    self._config = config
+    self._config_stamp = stamp
+    self._branches = {}
+
+  def BranchConfig(self, branchname:str, key:str) -> typing.Optional[str]:
+    with self._lock:
+      self._Refresh()
+      return self._config.get(f'branch.{branchname}.{key.lower()}', None)
+
+  def Branch(self, cls, branchname:str):
+    cachekey = (cls.__name__, branchname)
+    with self._lock:
+      self._Refresh()
+      entry = self._branches.get(cachekey, None)
+    if entry is not None:
+      libmetrics.Cache('librepo.branches').Hit()
+      return entry[1]
+    libmetrics.Cache('librepo.branches').Miss()
+    # Constructing a branch reads its config, so not under the lock.
+    branch = cls(branchname, self.root)
+    with self._lock:
+      return self._branches.setdefault(cachekey, (time.monotonic(), branch))[1]
+
+  def _BranchEntries(self) -> typing.List[tuple]:
+    with self._lock:
+      return list(self._branches.values())
+
+  def _EvictBranches(self, cached_before:float) -> int:
+    with self._lock:
+      stale = [key for key, (cached_at, _) in self._branches.items()
+               if cached_at <= cached_before]
+      for key in stale:
+        del self._branches[key]
+    libmetrics.Cache('librepo.branches').Evict(len(stale))
+    return len(stale)
+
+  def Submit(self, lane:int, function:typing.Callable, key=None) -> bool:
+    with self._lock:
+      if self._scheduler is None:
+        self._scheduler = libscheduler.ForRepository()
+    return self._scheduler.Submit(lane, function, key=key)
+
+  def SchedulerStats(self) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    with self._lock:
+      scheduler = self._scheduler
+    return scheduler.Stats() if scheduler is not None else None
+
+  def StopScheduler(self):
+    with self._lock:
+      scheduler, self._scheduler = self._scheduler, None
+    if scheduler is not None:
+      scheduler.Stop()
+
+
+_REPOSITORIES:typing.Dict[str, Repository] = {}
+_ROOTS:typing.Dict[str, typing.Optional[str]] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def FindRoot(path:str) -> typing.Optional[str]:
+  directory = os.path.normpath(path)
+  if not os.path.isdir(directory):
+    directory = os.path.dirname(directory)
+  with _REGISTRY_LOCK:
+    if directory in _ROOTS:
+      return _ROOTS[directory]
+  visited = []
+  root = None
+  while True:
+    with _REGISTRY_LOCK:
+      if directory in _ROOTS:
+        root = _ROOTS[directory]
+        break
+    visited.append(directory)
+    # Worktrees and submodules have a .git file rather than a directory.
+    if os.path.exists(os.path.join(directory, '.git')):
+      root = directory
+      break
+    parent = os.path.dirname(directory)
+    if parent == directory:
+      break
+    directory = parent
+  with _REGISTRY_LOCK:
+    for directory in visited:
+      _ROOTS[directory] = root
+  return root
+
+
+def Get(root:str) -> Repository:
+  root = os.path.normpath(root)
+  with _REGISTRY_LOCK:
+    if root not in _REPOSITORIES:
+      _REPOSITORIES[root] = Repository(root)
+    return _REPOSITORIES[root]
+
+
+def ForDirectory(directory:str) -> Repository:
+  return Get(FindRoot(directory) or directory)
+
+
+def Checkouts() -> typing.List[str]:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  checkouts = [settings['chromium_checkout']]
+  checkouts.extend(settings.get('checkouts', []))
+  return [os.path.normpath(checkout) for checkout in checkouts if checkout]
+
+
+# The configured checkout which owns `path`, if any.
+def ForPath(path:typing.Optional[str]) -> typing.Optional[Repository]:
+  if not path:
+    return None
+  root = FindRoot(path)
+  if root is None or root not in Checkouts():
+    return None
+  return Get(root)
+
+
+# The checkout of the window's active file, falling back to the
+# chromium_checkout setting for sheets and files outside of any checkout.
+def ForWindow(window:sublime.Window) -> Repository:
+  view = window.active_view() if window is not None else None
+  repository = ForPath(view.file_name() if view is not None else None)
+  if repository is None:
+    repository = Get(Checkouts()[0])
+  return repository
+
+
+def Repositories() -> typing.List[Repository]:
+  with _REGISTRY_LOCK:
+    return list(_REPOSITORIES.values())
+
+
+def Shutdown():
+  for repository in Repositories():
+    repository.StopScheduler()
+
+
+def _BranchEntries() -> typing.List[tuple]:
+  return [entry for repository in Repositories()
+          for entry in repository._BranchEntries()]
+
+
+def _EvictBranches(count:int) -> int:
+  cached_at = sorted(entry[0] for entry in _BranchEntries())
+  if not cached_at or count <= 0:
+    return 0
+  cutoff = cached_at[min(count, len(cached_at)) - 1]
+  return sum(repository._EvictBranches(cutoff)
+             for repository in Repositories())
+
+
+def _EvictRoots(count:int) -> int:
+  with _REGISTRY_LOCK:
+    evicted = list(_ROOTS)[:max(0, count)]
+    for directory in evicted:
+      del _ROOTS[directory]
+  return len(evicted)
+
+
+# Evicted branches are simply rebuilt from the git config, and their gerrit
+# data fetched again, the next time they are asked for.
+libcaches.EnrollCustom('librepo.branches', _BranchEntries, _EvictBranches)
+libcaches.EnrollCustom('librepo.roots', lambda: [
+  (None, item) for item in list(_ROOTS.items())], _EvictRoots)
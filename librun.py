@@ -1,8 +1,21 @@
 
+import asyncio
 import subprocess
+import threading
+import time
+import typing
 
+from . import libmetrics
+from . import librecord
 
-def RunCommand(command, cwd=None):
+
+MAX_CONCURRENT_COMMANDS = 8
+
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _Run(command, cwd):
   return subprocess.run(command,
                         encoding='utf-8',
                         shell=True,
@@ -11,6 +24,69 @@ def RunCommand(command, cwd=None):
                         stdout=subprocess.PIPE)
 
 
+def _Record(command, start, result):
+  libmetrics.GetHistogram('git', libmetrics.GitSubcommand(command)).Record(
+    time.perf_counter() - start, result.returncode == 0)
+  return result
+
+
+def RunCommand(command, cwd=None):
+  start = time.perf_counter()
+  return _Record(command, start, librecord.RunCommand(
+    command, cwd, lambda: _Run(command, cwd)))
+
+
+def _Serve(loop:asyncio.AbstractEventLoop):
+  loop.run_forever()
+  loop.close()
+
+
+def _EventLoop() -> asyncio.AbstractEventLoop:
+  global _LOOP
+  with _LOOP_LOCK:
+    if _LOOP is None:
+      _LOOP = asyncio.new_event_loop()
+      threading.Thread(target=_Serve, args=(_LOOP,), name='librun',
+                       daemon=True).start()
+    return _LOOP
+
+
+def Shutdown():
+  global _LOOP
+  with _LOOP_LOCK:
+    loop, _LOOP = _LOOP, None
+  if loop is not None:
+    loop.call_soon_threadsafe(loop.stop)
+
+
+async def _RunAsync(command, cwd):
+  process = await asyncio.create_subprocess_shell(command,
+                                                  cwd=cwd,
+                                                  stderr=subprocess.PIPE,
+                                                  stdout=subprocess.PIPE)
+  stdout, stderr = await process.communicate()
+  return subprocess.CompletedProcess(command, process.returncode,
+                                     stdout.decode('utf-8'),
+                                     stderr.decode('utf-8'))
+
+
+# Runs (command, cwd) pairs concurrently, returning results in the same order.
+def RunCommands(commands:typing.List[typing.Tuple[str, str]],
+                limit:int=MAX_CONCURRENT_COMMANDS):
+  if not commands:
+    return []
+  async def Gather():
+    semaphore = asyncio.Semaphore(limit)
+    async def Run(command, cwd):
+      # Time spent waiting for a slot isn't the command's own latency.
+      async with semaphore:
+        start = time.perf_counter()
+        return _Record(command, start, await librecord.RunCommandAsync(
+          command, cwd, lambda: _RunAsync(command, cwd)))
+    return await asyncio.gather(*(Run(c, d) for c, d in commands))
+  return asyncio.run_coroutine_threadsafe(Gather(), _EventLoop()).result()
+
+
 def OutputOrError(cmd, cwd=None):
   result = RunCommand(cmd, cwd=cwd)
   if result.returncode:
@@ -0,0 +1,166 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+import typing
+import sublime
+
+
+# Lanes, most important first. A job only runs once every lane in front of it
+# is empty.
+INTERACTIVE = 0
+VISIBLE = 1
+PREFETCH = 2
+LANE_NAMES = ('interactive', 'visible', 'prefetch')
+
+DEFAULT_WORKERS = 4
+DEFAULT_PREFETCH_CONCURRENCY = 2
+
+
+class LaneStats(typing.NamedTuple):
+  depth: int
+  submitted: int
+  deduplicated: int
+  completed: int
+  failed: int
+  mean_wait: float
+  max_wait: float
+
+
+class _Job():
+  def __init__(self, lane:int, key, function:typing.Callable):
+    self.lane = lane
+    self.key = key
+    self.function = function
+    self.enqueued_at = time.monotonic()
+    self.cancelled = False
+
+
+class Scheduler():
+  def __init__(self, workers:int, lane_limits:typing.Dict[int, int]=None):
+    self._condition = threading.Condition()
+    self._lane_limits = lane_limits or {}
+    self._lane_running = collections.Counter()
+    self._lane_parked = collections.defaultdict(list)
+    self._heap = []
+    self._sequence = itertools.count()
+    self._queued:typing.Dict[typing.Any, _Job] = {}
+    self._running_keys = set()
+    self._parked:typing.Dict[typing.Any, typing.List[_Job]] = {}
+    self._counters = [collections.Counter() for _ in LANE_NAMES]
+    self._max_wait = [0.0 for _ in LANE_NAMES]
+    self._stopped = False
+    for index in range(workers):
+      threading.Thread(target=self._Work, name=f'scheduler-{index}',
+                       daemon=True).start()
+
+  def Submit(self, lane:int, function:typing.Callable, key=None) -> bool:
+    with self._condition:
+      self._counters[lane]['submitted'] += 1
+      queued = self._queued.get(key, None) if key is not None else None
+      if queued is not None:
+        self._counters[lane]['deduplicated'] += 1
+        if queued.lane <= lane:
+          return False
+        # Same work, but now someone is waiting on it. Move it up a lane.
+        queued.cancelled = True
+      job = _Job(lane, key, function)
+      if key is not None:
+        self._queued[key] = job
+      self._Push(job)
+      return True
+
+  def _Push(self, job:_Job):
+    heapq.heappush(self._heap, (job.lane, next(self._sequence), job))
+    self._condition.notify()
+
+  # None once the scheduler is stopped.
+  def _Pop(self) -> typing.Optional[_Job]:
+    with self._condition:
+      while True:
+        while not self._heap and not self._stopped:
+          self._condition.wait()
+        if self._stopped:
+          return None
+        _, _, job = heapq.heappop(self._heap)
+        if job.cancelled:
+          continue
+        if job.key is not None and job.key in self._running_keys:
+          # Identical jobs never run at the same time; retry once it's done.
+          self._parked.setdefault(job.key, []).append(job)
+          continue
+        if self._lane_running[job.lane] >= self._lane_limits.get(job.lane, 1e9):
+          # Keep a worker free for the other lanes.
+          self._lane_parked[job.lane].append(job)
+          continue
+        self._lane_running[job.lane] += 1
+        if job.key is not None:
+          self._queued.pop(job.key, None)
+          self._running_keys.add(job.key)
+        wait = time.monotonic() - job.enqueued_at
+        self._counters[job.lane]['started'] += 1
+        self._counters[job.lane]['waited'] += wait
+        self._max_wait[job.lane] = max(self._max_wait[job.lane], wait)
+        return job
+
+  def _Work(self):
+    while True:
+      job = self._Pop()
+      if job is None:
+        return
+      try:
+        job.function()
+        outcome = 'completed'
+      except Exception as e:
+        print(f'scheduled job {job.key} failed: {e}')
+        outcome = 'failed'
+      with self._condition:
+        self._counters[job.lane][outcome] += 1
+        self._lane_running[job.lane] -= 1
+        if self._lane_parked[job.lane]:
+          self._Push(self._lane_parked[job.lane].pop(0))
+        if job.key is not None:
+          self._running_keys.discard(job.key)
+          for parked in self._parked.pop(job.key, []):
+            self._Push(parked)
+
+  def Stats(self) -> typing.Dict[str, LaneStats]:
+    with self._condition:
+      depth = collections.Counter(
+        job.lane for _, _, job in self._heap if not job.cancelled)
+      for lane, parked in self._lane_parked.items():
+        depth[lane] += len(parked)
+      # Those waiting on an identical job are still backlog.
+      for parked in self._parked.values():
+        depth.update(job.lane for job in parked)
+      stats = {}
+      for lane, name in enumerate(LANE_NAMES):
+        counters = self._counters[lane]
+        started = counters['started']
+        stats[name] = LaneStats(
+          depth=depth[lane],
+          submitted=counters['submitted'],
+          deduplicated=counters['deduplicated'],
+          completed=counters['completed'],
+          failed=counters['failed'],
+          mean_wait=counters['waited'] / started if started else 0,
+          max_wait=self._max_wait[lane])
+      return stats
+
+
+  # Jobs still queued are dropped. Workers exit once their current job is done,
+  # so this never waits on them.
+  def Stop(self):
+    with self._condition:
+      self._stopped = True
+      self._condition.notify_all()
+
+
+# Each checkout gets its own workers, so one checkout can't starve another.
+def ForRepository() -> Scheduler:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  return Scheduler(
+    settings.get('scheduler_workers', DEFAULT_WORKERS),
+    {PREFETCH: settings.get('prefetch_concurrency',
+                            DEFAULT_PREFETCH_CONCURRENCY)})
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+import sublime
+
+from . import libcaches
+from . import libfetch
+from . import libgerrit
+
+
+DEFAULT_MAX_SNAPSHOTS = 64
+DEFAULT_FRESH_SECONDS = 30
+
+
+CommentMapType = typing.Mapping[str, typing.List[libgerrit.ChangeComment]]
+
+
+# meta_rev_id moves on every update, but older servers only have `updated`.
+def ChangeVersion(change_json:dict) -> typing.Optional[str]:
+  return change_json.get('meta_rev_id', None) or change_json.get('updated', None)
+
+
+class Snapshot(typing.NamedTuple):
+  server: str
+  change_id: str
+  change_json: dict
+  comments_json: dict
+
+  def ChangeInfo(self) -> libgerrit.ChangeInfo:
+    return libfetch.InstanceFromJson(libgerrit.ChangeInfo, self.change_json)
+
+  def CommentMap(self) -> CommentMapType:
+    return libfetch.InstanceMapFromJson(libgerrit.ChangeComment,
+                                        self.comments_json)
+
+  def Version(self) -> typing.Optional[str]:
+    return ChangeVersion(self.change_json)
+
+
+_VALIDATED_AT:typing.Dict[str, float] = {}
+_LOCK = threading.Lock()
+
+
+def _MaxSnapshots() -> int:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  return settings.get('snapshot_max_changes', DEFAULT_MAX_SNAPSHOTS)
+
+
+# Snapshots dropped from memory are read back from disk on the next Load.
+_MEMORY = libcaches.LruCache('libsnapshot.memory', _MaxSnapshots)
+
+
+def _Directory() -> str:
+  return os.path.join(sublime.cache_path(), 'SublimeGerrit', 'snapshots')
+
+
+def _Key(server:str, change_id) -> str:
+  return hashlib.sha1(f'{server}/{change_id}'.encode()).hexdigest()
+
+
+def _Path(key:str) -> str:
+  return os.path.join(_Directory(), f'{key}.json')
+
+
+def _EnforceBound():
+  limit = _MaxSnapshots()
+  try:
+    # Only finished snapshots: a .tmp file may be about to be renamed.
+    files = [os.path.join(_Directory(), f) for f in os.listdir(_Directory())
+             if f.endswith('.json')]
+  except FileNotFoundError:
+    return
+  files.sort(key=os.path.getmtime)
+  for file in files[:max(0, len(files) - limit)]:
+    os.remove(file)
+
+
+def Load(server:str, change_id) -> typing.Optional[Snapshot]:
+  key = _Key(server, change_id)
+  with _LOCK:
+    found, snapshot = _MEMORY.Lookup(key)
+    if found:
+      return snapshot
+    try:
+      with open(_Path(key)) as f:
+        stored = json.load(f)
+    except (OSError, ValueError):
+      return None
+    snapshot = Snapshot(server, str(change_id),
+                        stored['change'], stored['comments'])
+    _MEMORY.Put(key, snapshot)
+    _EnforceBound()
+    return snapshot
+
+
+def Save(snapshot:Snapshot):
+  key = _Key(snapshot.server, snapshot.change_id)
+  with _LOCK:
+    _MEMORY.Put(key, snapshot)
+    os.makedirs(_Directory(), exist_ok=True)
+    # Write then rename, so a crash never leaves a half written snapshot.
+    temporary = _Path(key) + '.tmp'
+    with open(temporary, 'w') as f:
+      json.dump({'change': snapshot.change_json,
+                 'comments': snapshot.comments_json}, f)
+    os.replace(temporary, _Path(key))
+    _EnforceBound()
+
+
+def _IsFresh(key:str) -> bool:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  fresh_for = settings.get('snapshot_fresh_seconds', DEFAULT_FRESH_SECONDS)
+  validated_at = _VALIDATED_AT.get(key, None)
+  return validated_at is not None and time.monotonic() - validated_at < fresh_for
+
+
+def Expire(server:str, change_id):
+  # The next Revalidate will check with gerrit even if it recently did.
+  _VALIDATED_AT.pop(_Key(server, change_id), None)
+
+
+# Returns `snapshot` itself if it is still current, otherwise a fresh one.
+def Revalidate(server:str, change_id,
+               snapshot:typing.Optional[Snapshot]) -> Snapshot:
+  key = _Key(server, change_id)
+  if snapshot and _IsFresh(key):
+    return snapshot
+  if snapshot:
+    # Most revalidations find nothing new, so ask for as little as possible
+    # until something has.
+    probe = libfetch.FetchJson(libgerrit.ChangeInfo.GetProbeUrlPattern().format(
+      server=server, change_id=change_id))
+    version = snapshot.Version()
+    # Without any version to compare, the snapshot is always refetched.
+    if version is not None and version == ChangeVersion(probe):
+      _VALIDATED_AT[key] = time.monotonic()
+      return snapshot
+  change_json = libfetch.TrimToType(libgerrit.ChangeInfo,
+    libfetch.FetchInstanceJson(libgerrit.ChangeInfo,
+                               server=server, change_id=change_id))
+  comments_json = {}
+  if change_json.get('total_comment_count', 0):
+    comments_json = libfetch.TrimToType(CommentMapType,
+      libfetch.FetchInstanceJson(libgerrit.ChangeComment,
+                                 server=server, change_id=change_id))
+  fresh = Snapshot(server, str(change_id), change_json, comments_json)
+  Save(fresh)
+  _VALIDATED_AT[key] = time.monotonic()
+  return fresh
@@ -1,6 +1,15 @@
 
+import re
 import typing
 
+from . import libcaches
+from . import libmetrics
+
+
+_WHITESPACE = re.compile(r'\s+')
+_LINE_BREAK = re.compile(r'\s*\n\s*')
+_AROUND_CSS_PUNCTUATION = re.compile(r'\s*([{};:,])\s*')
+
 
 class ControlEntry(typing.NamedTuple):
   text_content: str
@@ -121,8 +130,38 @@ def _RenderTreeWithScope(tree:typing.List, env, kwargs):
       yield str(_ComputeLookup(branch.text_content, env, kwargs))
 
 
+# Parsing is by far the slowest part of rendering, and there are only ever a
+# handful of distinct templates.
+_PARSED_TEMPLATES = {}
+libcaches.EnrollCustom('libtemplate.parsed', lambda: [
+  (None, tree) for tree in list(_PARSED_TEMPLATES.values())])
+
+
 def Render(template:str, **kwargs):
-  ctrls = _TemplateToControlsList(template)
-  ctrl_tree = _DropControlsListIntoTree(ctrls)
-  output = _RenderTreeWithScope(ctrl_tree, None, kwargs)
+  if template in _PARSED_TEMPLATES:
+    libmetrics.Cache('libtemplate.parsed').Hit()
+  else:
+    libmetrics.Cache('libtemplate.parsed').Miss()
+    ctrls = _TemplateToControlsList(template)
+    _PARSED_TEMPLATES[template] = _DropControlsListIntoTree(ctrls)
+  output = _RenderTreeWithScope(_PARSED_TEMPLATES[template], None, kwargs)
   return ''.join(output)
+
+
+def _JoinLines(match) -> str:
+  before = match.string[match.start() - 1:match.start()]
+  after = match.string[match.end():match.end() + 1]
+  if before in ('>', '') or after in ('<', ''):
+    return ''
+  return ' '
+
+
+def MinifyHtml(html:str) -> str:
+  # Only meant for templates and static markup: a line break next to a tag is
+  # just indentation, while any other whitespace still separates words.
+  return _LINE_BREAK.sub(_JoinLines, html.strip())
+
+
+def MinifyCss(css:str) -> str:
+  css = _AROUND_CSS_PUNCTUATION.sub(r'\1', _WHITESPACE.sub(' ', css))
+  return css.replace(';}', '}').strip()
@@ -0,0 +1,70 @@
+import typing
+
+from . import libcaches
+from . import libgerrit
+
+
+# filename => root comment id => every comment of that thread, oldest first.
+ChangeThreads = typing.Mapping[str, typing.Mapping[str, typing.List[libgerrit.ChangeComment]]]
+
+
+_CACHE = libcaches.LruCache('libthreads.threads', 16)
+
+
+def _RootResolver(parents:typing.Dict[str, str]):
+  roots = {}
+  def Root(comment_id:str) -> str:
+    path = []
+    seen = set()
+    while comment_id not in roots:
+      path.append(comment_id)
+      seen.add(comment_id)
+      parent = parents.get(comment_id, None)
+      # Replies to comments we don't know about (or loops, which gerrit should
+      # never send) start a thread of their own.
+      if parent is None or parent not in parents or parent in seen:
+        roots[comment_id] = comment_id
+        break
+      comment_id = parent
+    root = roots[comment_id]
+    for visited in path:
+      roots[visited] = root
+    return root
+  return Root
+
+
+def BuildChangeThreads(comment_map) -> ChangeThreads:
+  parents = {}
+  for comments in comment_map.values():
+    for comment in comments:
+      parents[comment.id] = comment.in_reply_to
+  root_of = _RootResolver(parents)
+
+  threads = {}
+  for filename, comments in comment_map.items():
+    file_threads = threads.setdefault(filename, {})
+    for comment in comments:
+      file_threads.setdefault(root_of(comment.id), []).append(comment)
+    for thread in file_threads.values():
+      # Gerrit timestamps sort lexicographically. sort() is stable, so
+      # comments sharing a timestamp keep the order gerrit sent them in.
+      thread.sort(key=lambda comment: comment.updated)
+  return threads
+
+
+def ThreadsForSnapshot(snapshot) -> ChangeThreads:
+  version = snapshot.Version()
+  if version is None:
+    # Nothing tells two versions of the change apart, so nothing is cached.
+    return BuildChangeThreads(snapshot.CommentMap())
+  key = (snapshot.server, snapshot.change_id, version)
+  found, threads = _CACHE.Lookup(key)
+  if not found:
+    threads = BuildChangeThreads(snapshot.CommentMap())
+    _CACHE.Put(key, threads)
+  return threads
+
+
+def UnresolvedThreadCounts(threads:ChangeThreads) -> typing.Dict[str, int]:
+  return {filename: sum(1 for t in file_threads.values() if t[-1].unresolved)
+          for filename, file_threads in threads.items()}
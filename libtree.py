@@ -1,10 +1,17 @@
 
+import collections
+import html
 import json
 import typing
 import sublime
 
+from . import libcaches
 from . import libgit
+from . import libmerged
 from . import libmodify
+from . import librun
+from . import libtemplate
+from . import libworktree
 
 CLOSE_BRANCH_STATUS_TAB = 'cr_close_active_branch_status'
 CHECKOUT_AND_REBASE = 'cr_checkout_and_rebase_branch'
@@ -12,6 +19,11 @@ SHOW_BRANCH_STATUS = 'cr_show_branch_status'
 CHECKOUT = 'cr_checkout_branch'
 OPEN_CHANGED_FILES = 'cr_open_changed_files'
 CR_NOP_TRAMPOLINE = 'cr_nop_trampoline'
+CURRENT_BRANCH = 'git branch --show-current'
+REBASE_ALL = 'cr_rebase_all_branches'
+TOGGLE_EXPANSION = 'cr_toggle_branch_expansion'
+FIND_MERGED = 'cr_find_merged_branches'
+DELETE_MERGED = 'cr_delete_merged_branches'
 
 
 def _CreateCommandLink(cmd:str, **args) -> str:
@@ -22,7 +34,7 @@ def _MakeLinkItem(text:str, command:str, **kwargs):
   if kwargs.get('reset', True):
     kwargs['then'] = [
       (CLOSE_BRANCH_STATUS_TAB, {}),
-      (SHOW_BRANCH_STATUS, {})
+      (SHOW_BRANCH_STATUS, {'checkout': kwargs.get('checkout', None)})
     ]
   yield '<li>'
   yield _CreateCommandLink(command, **kwargs)
@@ -31,15 +43,24 @@ def _MakeLinkItem(text:str, command:str, **kwargs):
   yield '</li>'
 
 
-def _MakeControls():
+def _MakeControls(checkout:str):
   yield '<ul class="pst_global_control">'
-  yield from _MakeLinkItem('Refresh', CR_NOP_TRAMPOLINE)
+  yield from _MakeLinkItem('Refresh', CR_NOP_TRAMPOLINE, checkout=checkout)
+  yield from _MakeLinkItem('Rebase all branches', REBASE_ALL, checkout=checkout)
+  yield from _MakeLinkItem('Find merged branches', FIND_MERGED,
+                           checkout=checkout)
+  # Branches only merged in gerrit are left to their own link, which asks.
+  merged = libmerged.LandedResults(checkout)
+  if merged:
+    yield from _MakeLinkItem(
+      f'Delete {len(merged)} landed branches and rebase their children',
+      DELETE_MERGED, branches=sorted(merged), checkout=checkout)
   yield '</ul>'
 
 
 def _CssTemplate():
   yield '<style>'
-  yield '''
+  yield libtemplate.MinifyCss('''
   .pst_container {
     background-color: #335C67;
     padding: 10px;
@@ -54,9 +75,21 @@ def _CssTemplate():
   .pst_current_True {
     color: #52D1DC;
   }
-  .pst_fileschanged {}
-  .pst_filechange {}
-  .pst_filedelts {}
+  .pst_conflict {
+    color: #F28F3B;
+  }
+  .pst_collapsed {
+    color: #947EB0;
+  }
+  .pst_fileschanged {
+    margin: 5px 0px;
+  }
+  .pst_filechange {
+    color: #F8EADD;
+  }
+  .pst_filedelts {
+    color: #947EB0;
+  }
   .pst_children {
     padding:10px;
     margin:0px;
@@ -64,19 +97,32 @@ def _CssTemplate():
   .pst_childwrapper {
     border-left: 3px solid #947EB0;
   }
-  '''
+  ''')
   yield '</style>'
 
 
 def _RenderHtmlStream(trees, **kwargs):
   yield '<body class="pst_render">'
   yield from _CssTemplate()
-  yield from _MakeControls()
+  yield from _MakeControls(kwargs['checkout'])
   for tree in trees:
     yield from tree.GenerateHTML(**kwargs)
   yield '</body>'
 
 
+def _FileStatsHtml(files:typing.List[libgit.FileStat]):
+  yield '<div class="pst_fileschanged">'
+  for stat in files:
+    yield '<div class="pst_filechange">'
+    yield html.escape(stat.path)
+    if stat.added is None:
+      yield ' <span class="pst_filedelts">binary</span>'
+    else:
+      yield f' <span class="pst_filedelts">+{stat.added} -{stat.deleted}</span>'
+    yield '</div>'
+  yield '</div>'
+
+
 class PatchSetTree(typing.NamedTuple):
   dependent_patches: typing.List['PatchSetTree']
   branch: libgit.Gerrit
@@ -95,8 +141,18 @@ class PatchSetTree(typing.NamedTuple):
     return PatchSetTree(**values)
 
   def GenerateHTML(self, **kwargs) -> [str]:
-    ahead, behind = self.branch.AheadBehindBranch()
-    current = self.branch.IsCurrent()
+    facts = kwargs.get('facts', {}).get(self.branch.branchname, None)
+    if facts is not None:
+      ahead, behind = facts.ahead, facts.behind
+    elif 'facts' in kwargs:
+      # Its parent couldn't be resolved, so there's nothing to count against.
+      ahead, behind = 0, 0
+    else:
+      ahead, behind = self.branch.AheadBehindBranch()
+    if 'current' in kwargs:
+      current = kwargs['current'] == self.branch.branchname
+    else:
+      current = self.branch.IsCurrent()
     clean = kwargs.get('clean', False)
 
     yield '<div class="pst_container">'
@@ -114,21 +170,22 @@ class PatchSetTree(typing.NamedTuple):
 
     if current:
       yield from _MakeLinkItem(
-        'Open Changed Files', OPEN_CHANGED_FILES, reset=False)
+        'Open Changed Files', OPEN_CHANGED_FILES, reset=False,
+        checkout=self.branch.git_dir)
 
     if not current and clean:
       yield from _MakeLinkItem(
-        'Checkout Branch', CHECKOUT, branch=self.branch.branchname)
+        'Checkout Branch', CHECKOUT, branch=self.branch.branchname,
+        checkout=self.branch.git_dir)
 
     if current and not clean:
       yield from _MakeLinkItem('Commit Changes to XXX files', 'CRNOTHIHNG')
 
-    if ahead == 0:
-      yield '<li>'
-      yield f'<a href="remove/{self.branch.branchname}">'
-      yield 'Remove this alread-merged branch'
-      yield '</a>'
-      yield '</li>'
+    merged = libmerged.LastResult(self.branch.git_dir, self.branch.branchname)
+    if merged:
+      yield from _MakeLinkItem(
+        f'{merged.Describe()}. Delete it', DELETE_MERGED,
+        branches=[self.branch.branchname], checkout=self.branch.git_dir)
 
     if current and ahead > 1:
       yield '<li>'
@@ -142,10 +199,34 @@ class PatchSetTree(typing.NamedTuple):
       if not current:
         message = f'Checkout and {message}'
       yield from _MakeLinkItem(
-        message, CHECKOUT_AND_REBASE, branch=self.branch.branchname)
+        message, CHECKOUT_AND_REBASE, branch=self.branch.branchname,
+        checkout=self.branch.git_dir)
+
+    hidden = kwargs.get('hidden_children', {}).get(self.branch.branchname, 0)
+    if self.dependent_patches:
+      yield from _MakeLinkItem('Collapse dependent branches', TOGGLE_EXPANSION,
+                               branch=self.branch.branchname, expand=False,
+                               checkout=self.branch.git_dir)
+    elif hidden:
+      yield from _MakeLinkItem(f'Expand {hidden} dependent branches',
+                               TOGGLE_EXPANSION, branch=self.branch.branchname,
+                               expand=True, checkout=self.branch.git_dir)
 
     yield '</ul>'
 
+    if facts is not None and facts.files:
+      yield from _FileStatsHtml(facts.files)
+
+    rebase = libworktree.LastResult(self.branch.git_dir, self.branch.branchname)
+    if rebase and rebase.IsConflict():
+      yield '<div class="pst_conflict">'
+      yield f'Rebase conflicts in: {", ".join(rebase.conflicts)}'
+      yield '</div>'
+    elif rebase and rebase.status == 'blocked':
+      yield '<div class="pst_conflict">'
+      yield 'Not rebased: a parent branch has conflicts'
+      yield '</div>'
+
     if self.dependent_patches:
       yield '<div class="pst_children">'
       for dependent in self.dependent_patches:
@@ -180,67 +261,113 @@ def GetAllPatchSets(gitdir:str) -> typing.List[PatchSetTree]:
 
 
 def RootPatchesToDescriptiveHtml(patches:typing.List[PatchSetTree]) -> str:
-  def CssTemplate():
-    yield '<style>'
-    yield '''
-    .pst_container {
-      background-color: #335C67;
-      padding: 10px;
-      margin-bottom: 10px;
-    }
-    .pst_name {
-      color: #F8EADD;
-    }
-    .pst_operations {
-      margin: 0px;
-    }
-    .pst_current_True {
-      color: #52D1DC;
-    }
-    .pst_fileschanged {}
-    .pst_filechange {}
-    .pst_filedelts {}
-    .pst_children {
-      padding:10px;
-      margin:0px;
-    }
-    .pst_childwrapper {
-      border-left: 3px solid #947EB0;
-    }
-    '''
-    yield '</style>'
-
   def RenderHtmlStream(**kwargs):
     yield '<body class="pst_render">'
-    yield from CssTemplate()
+    yield from _CssTemplate()
     for patch in patches:
       yield from patch.GenerateHTML(**kwargs)
     yield '</body>'
 
-  clean = not libmodify.CurrentBranchDirty(self.branch.git_dir)
+  clean = not patches or not libmodify.CurrentBranchDirty(
+    patches[0].branch.git_dir)
 
-  return '\n'.join(RenderHtmlStream())
+  return ''.join(RenderHtmlStream(clean=clean))
 
 
-def RenderAllPatches(gitdir:str) -> str:
-  root_trees:typing.List[PatchSetTree] = []
+def _StoredBranches(gitdir:str, setting:str) -> typing.Set[str]:
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  return set(settings.get(setting, {}).get(gitdir, []))
 
-  tree_patches:typing.Dict[str, PatchSetTree] = {}
-  gerrit_branches:typing.Dict[str, libgit.Gerrit] = {}
 
-  for branch in libgit.Gerrit.GetAllNamedLocalBranches(gitdir):
-    if branch.branchname != 'main':
-      gerrit_branches[branch.branchname] = branch
-      tree_patches[branch.branchname] = PatchSetTree([], branch)
+def ExpandedBranches(gitdir:str) -> typing.Set[str]:
+  return _StoredBranches(gitdir, 'expanded_branches')
 
-  for branchname, branch in gerrit_branches.items():
-    parent = branch.Parent()
-    if parent is None or parent.branchname == 'main':
-      root_trees.append(tree_patches[branchname])
+
+# Ancestors of the checked out branch are expanded unless they are in here.
+def CollapsedBranches(gitdir:str) -> typing.Set[str]:
+  return _StoredBranches(gitdir, 'collapsed_branches')
+
+
+def SetExpansion(gitdir:str, branchname:str, expand:bool):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  for setting, add in (('expanded_branches', expand),
+                       ('collapsed_branches', not expand)):
+    stored = settings.get(setting, {})
+    branches = set(stored.get(gitdir, [])) - {branchname}
+    if add:
+      branches.add(branchname)
+    stored[gitdir] = sorted(branches)
+    settings.set(setting, stored)
+  sublime.save_settings('Chromium.sublime-settings')
+
+
+# The branches shown by the last render of each checkout.
+_RENDERED_BRANCHES:typing.Dict[str, typing.List[libgit.Gerrit]] = {}
+libcaches.EnrollCustom('libtree.rendered_branches', lambda: [
+  (None, shown) for shown in list(_RENDERED_BRANCHES.values())])
+
+
+def RenderedBranches(gitdir:str) -> typing.List[libgit.Gerrit]:
+  return _RENDERED_BRANCHES.get(gitdir, [])
+
+
+def _BuildVisibleTrees(gitdir:str, parents:typing.Dict[str, str],
+                       expanded:typing.Set[str]):
+  children = collections.defaultdict(list)
+  for branchname, parent in parents.items():
+    if branchname != 'main':
+      children[parent if parent in parents and parent != 'main' else None].append(
+        branchname)
+
+  hidden_children = {}
+  def Build(branchname:str) -> typing.List[PatchSetTree]:
+    try:
+      branch = libgit.Gerrit.Get(branchname, gitdir)
+    except Exception:
+      # Not a gerrit branch, so it isn't shown. Its children take its place.
+      return [tree for child in children[branchname] for tree in Build(child)]
+    tree = PatchSetTree([], branch)
+    if branchname in expanded:
+      for child in children[branchname]:
+        tree.dependent_patches.extend(Build(child))
     else:
-      tree_patches[parent.branchname].dependent_patches.append(
-        tree_patches[branchname])
+      hidden_children[branchname] = len(children[branchname])
+    return [tree]
+
+  roots = [tree for root in children[None] for tree in Build(root)]
+  return roots, hidden_children
 
-  clean = not libmodify.CurrentBranchDirty(gitdir)
-  return '\n'.join(_RenderHtmlStream(root_trees, clean=clean))
 
+def _Flatten(trees:typing.List[PatchSetTree]) -> typing.Iterator[PatchSetTree]:
+  for tree in trees:
+    yield tree
+    yield from _Flatten(tree.dependent_patches)
+
+
+def RenderAllPatches(gitdir:str) -> str:
+  # Only the parents of every branch are needed up front; everything else is
+  # only computed for the branches which are actually shown.
+  parents = libgit.AllBranchParents(gitdir)
+  current = librun.OutputOrError(CURRENT_BRANCH, cwd=gitdir)
+  expanded = ExpandedBranches(gitdir)
+  collapsed = CollapsedBranches(gitdir)
+  ancestor = parents.get(current, None)
+  seen = set()
+  while ancestor in parents and ancestor not in seen:
+    seen.add(ancestor)
+    if ancestor not in collapsed:
+      expanded.add(ancestor)
+    ancestor = parents[ancestor]
+
+  root_trees, hidden_children = _BuildVisibleTrees(gitdir, parents, expanded)
+  shown = [tree.branch for tree in _Flatten(root_trees)]
+  _RENDERED_BRANCHES[gitdir] = shown
+
+  # Every per-branch git query runs up front and concurrently, so rendering
+  # takes as long as the slowest query rather than the sum of all of them.
+  facts = libgit.GatherBranchFacts(shown, gitdir, parents)
+
+  clean = not libmodify.CurrentBranchDirty(gitdir)
+  return ''.join(_RenderHtmlStream(
+    root_trees, clean=clean, facts=facts, current=current,
+    hidden_children=hidden_children, checkout=gitdir))
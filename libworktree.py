@@ -0,0 +1,193 @@
+import concurrent.futures
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import typing
+
+from . import libgit
+from . import librun
+
+
+CURRENT_BRANCH = 'git branch --show-current'
+IS_ANCESTOR = 'git merge-base --is-ancestor {}@{{u}} {}'
+WORKTREE_ADD = 'git worktree add --detach "{}"'
+WORKTREE_REMOVE = 'git worktree remove --force "{}"'
+WORKTREE_PRUNE = 'git worktree prune'
+WORKTREE_CHECKOUT = 'git checkout --quiet {}'
+WORKTREE_DETACH = 'git checkout --quiet --detach'
+REBASE = 'git rebase'
+REBASE_ONTO = 'git rebase --onto {} {}'
+REBASE_ABORT = 'git rebase --abort'
+CONFLICTED_FILES = 'git diff --name-only --diff-filter=U'
+
+
+# Results of the most recent pool run, keyed by checkout and then by branch.
+_LAST_RESULTS:typing.Dict[str, typing.Dict[str, 'RebaseResult']] = {}
+
+
+class RebaseResult(typing.NamedTuple):
+  branchname: str
+  status: str
+  # Only set when status is 'conflict'.
+  conflicts: typing.Optional[typing.List[str]] = None
+
+  def IsConflict(self) -> bool:
+    return self.status == 'conflict'
+
+
+def _PoolRoot(gitdir:str) -> str:
+  digest = hashlib.sha1(gitdir.encode()).hexdigest()[:12]
+  return os.path.join(tempfile.gettempdir(), 'sublime_gerrit', digest)
+
+
+class WorktreePool():
+  def __init__(self, gitdir:str, size:int, root:str=None):
+    if root is None:
+      root = _PoolRoot(gitdir)
+    self._gitdir = gitdir
+    self._root = root
+    self._size = size
+    self._created:typing.List[str] = []
+    self._available = queue.Queue()
+    self._lock = threading.Lock()
+
+  def Acquire(self) -> str:
+    with self._lock:
+      if self._available.empty() and len(self._created) < self._size:
+        path = os.path.join(self._root, f'worktree_{len(self._created)}')
+        if os.path.exists(path):
+          librun.RunCommand(WORKTREE_REMOVE.format(path), cwd=self._gitdir)
+          shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(self._root, exist_ok=True)
+        librun.OutputOrError(WORKTREE_ADD.format(path), cwd=self._gitdir)
+        self._created.append(path)
+        return path
+    return self._available.get()
+
+  def Release(self, path:str):
+    # Never leave a branch checked out in a pooled worktree, or the user won't
+    # be able to check it out in their own checkout.
+    librun.RunCommand(WORKTREE_DETACH, cwd=path)
+    self._available.put(path)
+
+  def Dispose(self):
+    for path in self._created:
+      librun.RunCommand(WORKTREE_REMOVE.format(path), cwd=self._gitdir)
+      shutil.rmtree(path, ignore_errors=True)
+    librun.RunCommand(WORKTREE_PRUNE, cwd=self._gitdir)
+    self._created = []
+
+
+def _RebaseInWorktree(worktree:str, branchname:str,
+                      rebase:str=REBASE) -> RebaseResult:
+  checkout = librun.RunCommand(WORKTREE_CHECKOUT.format(branchname),
+                               cwd=worktree)
+  if checkout.returncode:
+    # Most likely checked out in some other worktree.
+    return RebaseResult(branchname, 'busy')
+  if not librun.RunCommand(rebase, cwd=worktree).returncode:
+    return RebaseResult(branchname, 'rebased')
+  conflicts = librun.RunCommand(CONFLICTED_FILES, cwd=worktree).stdout.split()
+  librun.RunCommand(REBASE_ABORT, cwd=worktree)
+  return RebaseResult(branchname, 'conflict', conflicts)
+
+
+def _IsUpToDate(gitdir:str, branchname:str) -> bool:
+  command = IS_ANCESTOR.format(branchname, branchname)
+  return not librun.RunCommand(command, cwd=gitdir).returncode
+
+
+def _RebaseSubtree(pool:WorktreePool, gitdir:str, current:str, root:str,
+                   children:typing.Dict[str, typing.List[str]]):
+  results = {}
+  worktree = None
+  pending = [root]
+  try:
+    while pending:
+      branchname = pending.pop()
+      if branchname == current:
+        results[branchname] = RebaseResult(branchname, 'current')
+      elif _IsUpToDate(gitdir, branchname):
+        results[branchname] = RebaseResult(branchname, 'uptodate')
+      else:
+        if worktree is None:
+          worktree = pool.Acquire()
+        results[branchname] = _RebaseInWorktree(worktree, branchname)
+      if results[branchname].status in ('conflict', 'busy'):
+        for child in _Descendants(branchname, children):
+          results[child] = RebaseResult(child, 'blocked')
+      else:
+        pending.extend(children.get(branchname, []))
+  finally:
+    if worktree is not None:
+      pool.Release(worktree)
+  return results
+
+
+def _Descendants(branchname:str, children:typing.Dict[str, typing.List[str]]):
+  for child in children.get(branchname, []):
+    yield child
+    yield from _Descendants(child, children)
+
+
+def RebaseAllBranches(gitdir:str, workers:int=4) -> typing.Dict[str, RebaseResult]:
+  current = librun.OutputOrError(CURRENT_BRANCH, cwd=gitdir)
+  roots = []
+  children:typing.Dict[str, typing.List[str]] = {}
+  for branch in libgit.Branch.GetAllNamedLocalBranches(gitdir):
+    if branch.branchname == 'main':
+      continue
+    parent = branch.Parent()
+    if parent is None or parent.branchname == 'main':
+      roots.append(branch.branchname)
+    else:
+      children.setdefault(parent.branchname, []).append(branch.branchname)
+
+  results = {}
+  pool = WorktreePool(gitdir, max(1, workers))
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as executor:
+      futures = [executor.submit(_RebaseSubtree, pool, gitdir, current, root,
+                                 children) for root in roots]
+      for future in concurrent.futures.as_completed(futures):
+        results.update(future.result())
+  finally:
+    pool.Dispose()
+
+  _LAST_RESULTS[gitdir] = results
+  return results
+
+
+# Moves the commits each branch has since `old_base` onto `onto`, given as
+# (branchname, onto, old_base). The checked out branch is left alone.
+def RebaseOnto(gitdir:str, moves:typing.List[typing.Tuple[str, str, str]],
+               workers:int=4) -> typing.Dict[str, RebaseResult]:
+  if not moves:
+    return {}
+  current = librun.OutputOrError(CURRENT_BRANCH, cwd=gitdir)
+  workers = max(1, min(workers, len(moves)))
+  # Apart from the pool RebaseAllBranches uses, which may be running too.
+  pool = WorktreePool(gitdir, workers, root=_PoolRoot(gitdir) + '_onto')
+  def Move(branchname:str, onto:str, old_base:str) -> RebaseResult:
+    if branchname == current:
+      return RebaseResult(branchname, 'current')
+    worktree = pool.Acquire()
+    try:
+      return _RebaseInWorktree(worktree, branchname,
+                               REBASE_ONTO.format(onto, old_base))
+    finally:
+      pool.Release(worktree)
+
+  try:
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+      results = list(executor.map(lambda move: Move(*move), moves))
+  finally:
+    pool.Dispose()
+  return {result.branchname: result for result in results}
+
+
+def LastResult(gitdir:str, branchname:str) -> typing.Optional[RebaseResult]:
+  return _LAST_RESULTS.get(gitdir, {}).get(branchname, None)
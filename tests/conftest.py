@@ -0,0 +1,131 @@
+import copy
+import http.server
+import importlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import pytest
+
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(_ROOT))
+PACKAGE = os.path.basename(_ROOT)
+
+
+class _Settings(dict):
+  # Like sublime's, reads hand out copies.
+  def __getitem__(self, key):
+    return copy.deepcopy(dict.__getitem__(self, key))
+
+  def get(self, key, default=None):
+    return copy.deepcopy(dict.get(self, key, default))
+
+  def set(self, key, value):
+    self[key] = copy.deepcopy(value)
+    for callback in list(self._callbacks.values()):
+      callback()
+
+  def add_on_change(self, tag, callback):
+    self._callbacks[tag] = callback
+
+  def clear_on_change(self, tag):
+    self._callbacks.pop(tag, None)
+
+
+def _FakeSublime() -> types.ModuleType:
+  # The sublime module only exists inside the editor.
+  sublime = types.ModuleType('sublime')
+  settings = {}
+  cache = tempfile.mkdtemp(prefix='sublime_cache')
+  def LoadSettings(name):
+    if name not in settings:
+      settings[name] = _Settings()
+      settings[name]._callbacks = {}
+    return settings[name]
+  sublime.load_settings = LoadSettings
+  sublime.save_settings = lambda name: None
+  sublime.status_message = lambda message: None
+  sublime.cache_path = lambda: cache
+  # Only used in annotations.
+  for name in ('View', 'Window', 'Region', 'PhantomSet'):
+    setattr(sublime, name, type(name, (), {}))
+  return sublime
+
+
+def _FakeSublimePlugin() -> types.ModuleType:
+  sublime_plugin = types.ModuleType('sublime_plugin')
+  for name in ('WindowCommand', 'EventListener'):
+    setattr(sublime_plugin, name, type(name, (), {}))
+  return sublime_plugin
+
+
+sys.modules.setdefault('sublime', _FakeSublime())
+sys.modules.setdefault('sublime_plugin', _FakeSublimePlugin())
+
+
+def Import(module:str) -> types.ModuleType:
+  return importlib.import_module(f'{PACKAGE}.{module}')
+
+
+# A local gerrit which answers from a script of faults and responses, and
+# records every request it was sent.
+class StubGerrit():
+  def __init__(self):
+    self.requests = []
+    self.script = []
+    self.on_post = None
+    stub = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def log_message(self, *args):
+        pass
+
+      def _Respond(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length)) if length else None
+        stub.requests.append((self.command, self.path, body))
+        if self.command == 'POST' and stub.on_post:
+          stub.on_post()
+        action, value = stub.script.pop(0) if stub.script else ('json', {})
+        if action == 'sleep':
+          time.sleep(value)
+          action, value = 'json', {}
+        if action == 'drop':
+          # Close the connection without sending a response at all.
+          self.close_connection = True
+          return
+        if action == 'status':
+          self.send_error(value)
+          return
+        if action == 'raw':
+          payload = value
+        else:
+          payload = b")]}'\n" + json.dumps(value).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+      do_GET = _Respond
+      do_POST = _Respond
+
+    self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    self._server.daemon_threads = True
+    self.url = f'http://127.0.0.1:{self._server.server_port}'
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+  def Stop(self):
+    self._server.shutdown()
+    self._server.server_close()
+
+
+@pytest.fixture
+def gerrit():
+  stub = StubGerrit()
+  yield stub
+  stub.Stop()
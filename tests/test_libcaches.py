@@ -0,0 +1,20 @@
+import typing
+
+from conftest import Import
+
+libcaches = Import('libcaches')
+
+
+class _Fields(typing.NamedTuple):
+  name: str
+
+
+class _WithAttributes(_Fields):
+  pass
+
+
+def test_size_counts_attributes_of_tuple_subclasses():
+  value = _WithAttributes('a')
+  value.payload = 'x' * 10000
+  assert libcaches.SizeOf(value) > 10000
+  assert libcaches.SizeOf(_Fields('a')) < 1000
@@ -0,0 +1,103 @@
+import time
+import urllib.error
+
+import pytest
+import sublime
+
+from conftest import Import
+
+libfetch = Import('libfetch')
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+  # Every backoff drawn, with the bounds it was drawn between.
+  drawn = []
+  uniform = libfetch.random.uniform
+  def Uniform(low, high):
+    value = uniform(low, high)
+    drawn.append((low, high, value))
+    return value
+  monkeypatch.setattr(libfetch.random, 'uniform', Uniform)
+  monkeypatch.setattr(libfetch, 'BACKOFF_BASE', 0.01)
+  return drawn
+
+
+def test_retries_server_errors_with_jittered_backoff(gerrit, backoffs):
+  gerrit.script = [('status', 503), ('status', 502), ('json', {'ok': 1})]
+  assert libfetch.FetchJson(f'{gerrit.url}/changes/1') == {'ok': 1}
+  assert len(gerrit.requests) == 3
+  assert [high for _, high, _ in backoffs] == [0.01, 0.02]
+  for low, high, value in backoffs:
+    assert low == 0 and low <= value <= high
+
+
+def test_retries_dropped_connections(gerrit, backoffs):
+  gerrit.script = [('drop', None), ('json', {'ok': 1})]
+  assert libfetch.FetchJson(f'{gerrit.url}/changes/1') == {'ok': 1}
+  assert len(gerrit.requests) == 2
+
+
+def test_client_errors_are_not_retried(gerrit, backoffs):
+  gerrit.script = [('status', 404)]
+  with pytest.raises(urllib.error.HTTPError):
+    libfetch.FetchJson(f'{gerrit.url}/changes/1')
+  assert len(gerrit.requests) == 1
+  assert not backoffs
+
+
+def test_gives_up_at_the_deadline(gerrit, backoffs, monkeypatch):
+  monkeypatch.setattr(libfetch, 'ATTEMPT_TIMEOUT', 0.2)
+  gerrit.script = [('sleep', 1)] * libfetch.MAX_ATTEMPTS
+  start = time.monotonic()
+  with pytest.raises(libfetch.FetchError):
+    libfetch.FetchJson(f'{gerrit.url}/changes/1', deadline=0.3)
+  assert time.monotonic() - start < 0.6
+  assert len(gerrit.requests) <= 2
+
+
+def test_breaker_opens_then_half_opens(gerrit, backoffs, monkeypatch):
+  monkeypatch.setattr(libfetch, 'BREAKER_COOLDOWN', 0.2)
+  uri = f'{gerrit.url}/changes/1'
+  attempts = libfetch.MAX_ATTEMPTS * libfetch.BREAKER_THRESHOLD
+  gerrit.script = [('status', 500)] * attempts
+  for _ in range(libfetch.BREAKER_THRESHOLD):
+    with pytest.raises(libfetch.FetchError):
+      libfetch.FetchJson(uri)
+  assert len(gerrit.requests) == attempts
+
+  # Open: nothing reaches the server.
+  with pytest.raises(libfetch.CircuitOpenError):
+    libfetch.FetchJson(uri)
+  assert len(gerrit.requests) == attempts
+
+  # Half open: a failed probe opens it again right away.
+  time.sleep(0.25)
+  gerrit.script = [('status', 500)] * libfetch.MAX_ATTEMPTS
+  with pytest.raises(libfetch.FetchError):
+    libfetch.FetchJson(uri)
+  with pytest.raises(libfetch.CircuitOpenError):
+    libfetch.FetchJson(uri)
+
+  # A successful probe closes it.
+  time.sleep(0.25)
+  gerrit.script = [('json', {'ok': 1})]
+  assert libfetch.FetchJson(uri) == {'ok': 1}
+  gerrit.script = [('json', {'ok': 2})]
+  assert libfetch.FetchJson(uri) == {'ok': 2}
+
+
+def test_every_request_takes_a_token(gerrit):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  settings.set('gerrit_requests_per_second', 20)
+  settings.set('gerrit_request_burst', 2)
+  try:
+    start = time.monotonic()
+    for change in range(4):
+      libfetch.FetchJson(f'{gerrit.url}/changes/{change}')
+  finally:
+    settings.pop('gerrit_requests_per_second')
+    settings.pop('gerrit_request_burst')
+  # Two requests fit the burst, the other two wait a twentieth of a second.
+  assert time.monotonic() - start >= 0.09
+  assert len(gerrit.requests) == 4
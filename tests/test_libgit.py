@@ -0,0 +1,37 @@
+import subprocess
+
+from conftest import Import
+
+libgit = Import('libgit')
+
+
+def _Git(checkout, *args) -> str:
+  return subprocess.run(('git', '-c', 'user.name=a', '-c', 'user.email=a@b') +
+                        args, cwd=checkout, check=True, capture_output=True,
+                        text=True).stdout.strip()
+
+
+def _Commit(checkout, filename:str):
+  (checkout / filename).write_text(filename)
+  _Git(checkout, 'add', filename)
+  _Git(checkout, 'commit', '-q', '-m', filename)
+
+
+def test_branches_without_a_resolvable_parent_are_left_out(tmp_path):
+  # No local main: branches without a parent have nothing to count against.
+  _Git(tmp_path, 'init', '-q', '-b', 'master')
+  _Commit(tmp_path, 'base')
+  _Git(tmp_path, 'checkout', '-q', '-b', 'orphan')
+  _Commit(tmp_path, 'orphan.txt')
+  _Git(tmp_path, 'checkout', '-q', '-b', 'child')
+  _Git(tmp_path, 'branch', '-q', '--set-upstream-to=orphan')
+  _Commit(tmp_path, 'child.txt')
+
+  branches = [libgit.Branch('orphan', str(tmp_path)),
+              libgit.Branch('child', str(tmp_path)),
+              libgit.Branch('deleted', str(tmp_path))]
+  facts = libgit.GatherBranchFacts(
+    branches, str(tmp_path), {'orphan': None, 'child': 'orphan',
+                              'deleted': 'orphan'})
+  assert facts == {'child': libgit.BranchFacts(
+    'orphan', 1, 0, [libgit.FileStat('child.txt', 1, 0)])}
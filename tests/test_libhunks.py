@@ -0,0 +1,42 @@
+import base64
+import types
+
+from conftest import Import
+
+libfetch = Import('libfetch')
+libhunks = Import('libhunks')
+
+
+def _Content(text:str) -> tuple:
+  return ('raw', base64.b64encode(text.encode()))
+
+
+def _Project(gerrit):
+  return types.SimpleNamespace(server=gerrit.url, upstream_change_id='1')
+
+
+def test_failed_loads_are_asked_for_again(tmp_path, gerrit, monkeypatch):
+  monkeypatch.setattr(libfetch, 'BACKOFF_BASE', 0.01)
+  project = _Project(gerrit)
+  # Not a git checkout, so the file comes from gerrit.
+  gerrit.script = [('status', 503)] * libfetch.MAX_ATTEMPTS
+  assert libhunks._RevisionLines(str(tmp_path), project, 'abc', 'a.cc') is None
+  gerrit.script = [_Content('one\ntwo\n')]
+  assert libhunks._RevisionLines(
+    str(tmp_path), project, 'abc', 'a.cc') == ['one', 'two']
+
+
+def test_older_patchsets_are_only_listed_when_needed(tmp_path, gerrit):
+  mapper = libhunks.LineMapper(str(tmp_path), _Project(gerrit), {2: 'sha2'},
+                               'b.cc', 'new\none\ntwo\n')
+  gerrit.script = [_Content('one\ntwo\n')]
+  assert mapper.Map(2, 2) == 3
+  gerrit.script = [
+    ('json', {'revisions': {'sha1': {'_number': 1}, 'sha2': {'_number': 2}}}),
+    _Content('two\n')]
+  assert mapper.Map(1, 1) == 3
+  assert [path for _, path, _ in gerrit.requests] == [
+    '/changes/1/revisions/sha2/files/b.cc/content',
+    '/changes/1?o=ALL_REVISIONS',
+    '/changes/1/revisions/sha1/files/b.cc/content',
+  ]
@@ -0,0 +1,95 @@
+import subprocess
+
+from conftest import Import
+
+libgit = Import('libgit')
+libmerged = Import('libmerged')
+
+
+def _Git(checkout, *args) -> str:
+  return subprocess.run(('git',) + args, cwd=checkout, check=True,
+                        capture_output=True, text=True).stdout.strip()
+
+
+def _Commit(checkout, filename:str, text:str):
+  (checkout / filename).write_text(text)
+  _Git(checkout, 'add', filename)
+  _Git(checkout, 'commit', '-q', '-m', filename)
+
+
+def _Branch(checkout, branchname:str, parent:str, filename:str):
+  _Git(checkout, 'checkout', '-q', '-b', branchname, parent)
+  _Git(checkout, 'branch', '-q', f'--set-upstream-to={parent}')
+  _Commit(checkout, filename, branchname)
+
+
+def _Upload(checkout, branchname:str, server:str, issue:int):
+  _Git(checkout, 'config', f'branch.{branchname}.gerritserver', server)
+  _Git(checkout, 'config', f'branch.{branchname}.gerritissue', str(issue))
+  _Git(checkout, 'config', f'branch.{branchname}.last-upload-hash',
+       _Git(checkout, 'rev-parse', branchname))
+
+
+def test_finds_and_deletes_merged_branches(tmp_path, gerrit):
+  _Git(tmp_path, 'init', '-q', '-b', 'main')
+  # Rebases in the worktrees commit too.
+  _Git(tmp_path, 'config', 'user.name', 'a')
+  _Git(tmp_path, 'config', 'user.email', 'a@b')
+  _Commit(tmp_path, 'base', 'base')
+  # `landed` was cherry-picked upstream, and `child` is stacked on it.
+  _Branch(tmp_path, 'landed', 'main', 'landed.txt')
+  _Branch(tmp_path, 'child', 'landed', 'child.txt')
+  # Both changes merged in gerrit, but `edited` has had a commit since.
+  _Branch(tmp_path, 'uploaded', 'main', 'uploaded.txt')
+  _Upload(tmp_path, 'uploaded', gerrit.url, 1)
+  _Branch(tmp_path, 'edited', 'main', 'edited.txt')
+  _Upload(tmp_path, 'edited', gerrit.url, 2)
+  _Commit(tmp_path, 'edited.txt', 'more')
+  _Git(tmp_path, 'checkout', '-q', 'main')
+  _Commit(tmp_path, 'upstream.txt', 'upstream')
+  _Git(tmp_path, 'cherry-pick', 'landed')
+
+  merged_changes = [{'_number': 1, 'status': 'MERGED'},
+                    {'_number': 2, 'status': 'MERGED'}]
+  gerrit.script = [('json', merged_changes)]
+  merged = libmerged.FindMergedBranches(str(tmp_path))
+  assert merged == {
+    'landed': libmerged.MergedBranch('landed', 'landed'),
+    'uploaded': libmerged.MergedBranch('uploaded', 'gerrit'),
+  }
+
+  # `uploaded` moved on after it was found.
+  _Git(tmp_path, 'checkout', '-q', 'uploaded')
+  _Commit(tmp_path, 'uploaded.txt', 'more')
+  _Git(tmp_path, 'checkout', '-q', 'main')
+  gerrit.script = [('json', merged_changes)]
+  deleted = libmerged.DeleteMergedBranches(str(tmp_path), sorted(merged), 1,
+                                          force=['uploaded'])
+  assert deleted == ['landed']
+  assert libmerged.LastResults(str(tmp_path)) == {}
+
+  # The child was rebased off the deleted branch, onto main.
+  parents = libgit.AllBranchParents(str(tmp_path))
+  assert 'landed' not in parents and parents['child'] == 'main'
+  assert _Git(tmp_path, 'rev-list', '--count', 'main..child') == '1'
+
+
+def test_unlanded_commits_are_only_deleted_when_forced(tmp_path, gerrit):
+  _Git(tmp_path, 'init', '-q', '-b', 'main')
+  _Git(tmp_path, 'config', 'user.name', 'a')
+  _Git(tmp_path, 'config', 'user.email', 'a@b')
+  _Commit(tmp_path, 'base', 'base')
+  # Merged in gerrit, but its commit never landed upstream.
+  _Branch(tmp_path, 'unlanded', 'main', 'unlanded.txt')
+  _Upload(tmp_path, 'unlanded', gerrit.url, 1)
+  _Git(tmp_path, 'checkout', '-q', 'main')
+
+  merged_changes = [{'_number': 1, 'status': 'MERGED'}]
+  gerrit.script = [('json', merged_changes)]
+  assert libmerged.DeleteMergedBranches(str(tmp_path), ['unlanded'], 1) == []
+  assert 'unlanded' in libgit.AllBranchParents(str(tmp_path))
+
+  gerrit.script = [('json', merged_changes)]
+  assert libmerged.DeleteMergedBranches(
+    str(tmp_path), ['unlanded'], 1, force=['unlanded']) == ['unlanded']
+  assert 'unlanded' not in libgit.AllBranchParents(str(tmp_path))
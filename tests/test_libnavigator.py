@@ -0,0 +1,48 @@
+import subprocess
+import types
+
+from conftest import Import
+
+libnavigator = Import('libnavigator')
+libsnapshot = Import('libsnapshot')
+
+
+def _Commit(checkout, text:str) -> str:
+  def Git(*args):
+    return subprocess.run(('git',) + args, cwd=checkout, check=True,
+                          capture_output=True, text=True).stdout.strip()
+  Git('init', '-q')
+  (checkout / 'a.cc').write_text(text)
+  Git('add', 'a.cc')
+  Git('-c', 'user.name=a', '-c', 'user.email=a@b', 'commit', '-q', '-m', 'a')
+  return Git('rev-parse', 'HEAD')
+
+
+def _Comment(comment_id:str, line:int) -> dict:
+  return {'author': {'account_id': 1, 'name': 'R', 'email': 'r@x'},
+          'change_message_id': 'm', 'unresolved': True, 'patch_set': 1,
+          'id': comment_id, 'updated': 't', 'message': 'fix', 'line': line}
+
+
+def test_threads_are_placed_on_their_mapped_lines(tmp_path):
+  sha = _Commit(tmp_path, 'one\ntwo\nthree\nfour\n')
+  change = {
+    'id': 'p~main~I1', 'triplet_id': 'p~main~I1', 'project': 'p',
+    'branch': 'main', 'change_id': 'I1', 'subject': 's', 'status': 'NEW',
+    'created': 'c', 'updated': 't1', 'submit_type': 'CHERRY_PICK',
+    'insertions': 1, 'deletions': 0, 'total_comment_count': 1,
+    'has_review_started': True, 'meta_rev_id': 'm1', 'current_revision': sha,
+    'revisions': {sha: {'kind': 'REWORK', '_number': 1, 'created': 'c',
+                        'ref': 'r', 'branch': 'main', 'description': 'd'}}}
+  snapshot = libsnapshot.Snapshot('https://gerrit', '1', change,
+                                  {'a.cc': [_Comment('c1', 3)]})
+  project = types.SimpleNamespace(server='https://gerrit',
+                                  upstream_change_id='1')
+  # Two lines were added above the comment since it was left.
+  edited = 'new\nnewer\none\ntwo\nthree\nfour\n'
+  index = libnavigator.IndexForSnapshot(
+    snapshot, str(tmp_path), project,
+    lambda filename: edited if filename == 'a.cc' else None)
+  assert [(t.filename, t.line) for t in index.threads] == [('a.cc', 5)]
+  assert index.Next('a.cc', 1).root_id == 'c1'
+  assert index.Next('a.cc', 5) is index.threads[0]
@@ -0,0 +1,84 @@
+from conftest import Import
+
+commands = Import('commands')
+libopenqueue = Import('libopenqueue')
+
+
+class _View():
+  def __init__(self, window, view_id:int, path:str):
+    self._window = window
+    self._id = view_id
+    self._path = path
+
+  def id(self) -> int:
+    return self._id
+
+  def window(self):
+    return self._window
+
+  def file_name(self) -> str:
+    return self._path
+
+  def is_loading(self) -> bool:
+    return False
+
+
+# Like the editor's: opening or focusing a view activates it, and the
+# listener hears about every activation afterwards, on another thread.
+class _Window():
+  def __init__(self):
+    self.views = {}
+    self.activated = []
+    self._active = None
+
+  def find_open_file(self, path:str):
+    return self.views.get(path, None)
+
+  def open_file(self, path:str):
+    view = _View(self, 100 + len(self.views), path)
+    self.views[path] = view
+    self.focus_view(view)
+    return view
+
+  def focus_view(self, view):
+    self._active = view
+    self.activated.append(view)
+
+  def active_view(self):
+    return self._active
+
+
+def test_only_the_foreground_view_renders_while_opening(monkeypatch):
+  rendered = []
+  listener = commands.ChangelistFileOpenListener()
+  monkeypatch.setattr(listener, '_RenderComments', rendered.append)
+  monkeypatch.setattr(commands.libpoller, 'NoteActivity', lambda: None)
+  monkeypatch.setattr(commands.libcodereview, 'WatchViewport', lambda v: None)
+
+  window = _Window()
+  already_open = window.open_file('/src/c.cc')
+  window.activated.clear()
+  queue = libopenqueue.OpenQueue(
+    window, '/src', ['a.cc', 'b.cc', 'c.cc', 'd.cc'], 4, 0)
+  queue._OpenBatch()
+
+  a, b, d = (window.views[f'/src/{name}'] for name in ('a.cc', 'b.cc', 'd.cc'))
+  assert window.active_view() is a
+  for view in (a, b, d):
+    listener.on_load_async(view)
+  for view in window.activated:
+    listener.on_activated_async(view)
+  assert rendered == [a]
+  assert not libopenqueue.IsDeferred(already_open)
+
+  # Until the user switches to them.
+  window.focus_view(d)
+  listener.on_activated_async(d)
+  assert rendered == [a, d]
+  window.focus_view(a)
+  listener.on_activated_async(a)
+  window.focus_view(d)
+  listener.on_activated_async(d)
+  assert rendered == [a, d]
+  listener.on_close(b)
+  assert not libopenqueue.IsDeferred(b)
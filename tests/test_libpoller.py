@@ -0,0 +1,33 @@
+import sublime
+
+from conftest import Import
+
+libpoller = Import('libpoller')
+
+
+def test_turning_polling_off_stops_it(monkeypatch):
+  scheduled = []
+  monkeypatch.setattr(libpoller, 'Poll', lambda: 0)
+  monkeypatch.setattr(libpoller, '_Schedule', scheduled.append)
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  settings.set('poll_interval_seconds', 30)
+  try:
+    libpoller.Start()
+    assert scheduled == [30]
+    libpoller._PollAndReschedule()
+    assert scheduled == [30, 30]
+
+    settings.set('poll_interval_seconds', 0)
+    libpoller._PollAndReschedule()
+    assert scheduled == [30, 30]
+    libpoller.NoteActivity()
+    assert scheduled == [30, 30]
+
+    # Turned back on, the next activity starts it again.
+    settings.set('poll_interval_seconds', 30)
+    libpoller.NoteActivity()
+    assert scheduled == [30, 30, 30]
+  finally:
+    settings.pop('poll_interval_seconds')
+    libpoller._ReadSettings()
+    libpoller._STARTED = False
@@ -0,0 +1,48 @@
+import types
+
+import sublime
+
+from conftest import Import
+
+libpublish = Import('libpublish')
+
+
+def _Draft(chain:str, line:int, content:str) -> dict:
+  return {'author': 'Me - Draft', 'date': '', 'content': content, 'line': line,
+          'is_applicable_suggestion': False, 'patch_set': 'abc',
+          'unresolved': False, 'upstream_message_id': None,
+          'comment_chain': chain}
+
+
+def test_publishes_every_draft_in_one_post(gerrit):
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  settings.set('pending_responses', {'7': {
+    '/src/a.cc': [_Draft('x1', 2, 'Done'), _Draft('x2', 4, 'Fixed')],
+    '/src/b.cc': [_Draft('x3', 9, 'Ack')],
+  }})
+  late = _Draft('x4', 12, 'Written while publishing')
+  def WriteDraftWhilePosting():
+    pending = settings['pending_responses']
+    pending['7']['/src/a.cc'].append(late)
+    settings.set('pending_responses', pending)
+  gerrit.on_post = WriteDraftWhilePosting
+
+  project = types.SimpleNamespace(server=gerrit.url, upstream_change_id='7')
+  published = libpublish.PublishDrafts(project, '/src')
+
+  assert sorted(published) == ['/src/a.cc', '/src/b.cc']
+  posts = [r for r in gerrit.requests if r[0] == 'POST']
+  assert len(posts) == 1
+  _, path, body = posts[0]
+  assert path == '/a/changes/7/revisions/current/review'
+  assert body == {'comments': {
+    'a.cc': [
+      {'in_reply_to': 'x1', 'message': 'Done', 'unresolved': False, 'line': 2},
+      {'in_reply_to': 'x2', 'message': 'Fixed', 'unresolved': False, 'line': 4},
+    ],
+    'b.cc': [
+      {'in_reply_to': 'x3', 'message': 'Ack', 'unresolved': False, 'line': 9},
+    ],
+  }}
+  # Only the draft which wasn't sent is left.
+  assert settings['pending_responses'] == {'7': {'/src/a.cc': [late]}}
@@ -0,0 +1,13 @@
+from conftest import Import
+
+libmetrics = Import('libmetrics')
+librun = Import('librun')
+
+
+def test_waiting_for_a_slot_is_not_timed():
+  results = librun.RunCommands([('sleep 0.2', None)] * 3, limit=1)
+  assert [result.returncode for result in results] == [0, 0, 0]
+  # Run one at a time, the last would have waited 0.4s before it started.
+  summary = libmetrics.GetHistogram('git', 'sleep').Summary()
+  assert summary.count == 3
+  assert summary.max < 0.35
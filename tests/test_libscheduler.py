@@ -0,0 +1,35 @@
+import threading
+import time
+
+from conftest import Import
+
+libscheduler = Import('libscheduler')
+
+
+def _Workers() -> int:
+  return sum(thread.name.startswith('scheduler-')
+             for thread in threading.enumerate())
+
+
+def test_jobs_parked_behind_a_busy_key_count_as_queued():
+  before = _Workers()
+  scheduler = libscheduler.Scheduler(2)
+  started, release = threading.Event(), threading.Event()
+  def Busy():
+    started.set()
+    release.wait()
+  scheduler.Submit(libscheduler.VISIBLE, Busy, key='render')
+  started.wait()
+  # Both workers are free, but the key is busy until the first one is done.
+  scheduler.Submit(libscheduler.VISIBLE, lambda: None, key='render')
+  deadline = time.monotonic() + 1
+  while scheduler._heap and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert scheduler.Stats()['visible'].depth == 1
+
+  release.set()
+  scheduler.Stop()
+  deadline = time.monotonic() + 1
+  while _Workers() > before and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert _Workers() == before
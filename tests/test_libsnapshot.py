@@ -0,0 +1,57 @@
+import os
+
+import sublime
+
+from conftest import Import
+
+libsnapshot = Import('libsnapshot')
+
+
+def _Change(updated:str) -> dict:
+  # As sent by servers too old to have meta_rev_id.
+  return {'id': 'p~main~I1', 'status': 'NEW', 'updated': updated,
+          'total_comment_count': 0, '_number': 1}
+
+
+def test_revalidate_falls_back_to_updated(gerrit):
+  gerrit.script = [('json', _Change('t1'))]
+  snapshot = libsnapshot.Revalidate(gerrit.url, 1, None)
+  assert snapshot.Version() == 't1'
+
+  libsnapshot.Expire(gerrit.url, 1)
+  gerrit.script = [('json', _Change('t1'))]
+  assert libsnapshot.Revalidate(gerrit.url, 1, snapshot) is snapshot
+
+  libsnapshot.Expire(gerrit.url, 1)
+  gerrit.script = [('json', _Change('t2')), ('json', _Change('t2'))]
+  fresh = libsnapshot.Revalidate(gerrit.url, 1, snapshot)
+  assert fresh.Version() == 't2'
+
+
+def test_revalidate_refetches_without_any_version(gerrit):
+  change = {'id': 'p~main~I1', 'status': 'NEW', 'total_comment_count': 0}
+  gerrit.script = [('json', change)]
+  snapshot = libsnapshot.Revalidate(gerrit.url, 2, None)
+  libsnapshot.Expire(gerrit.url, 2)
+  gerrit.script = [('json', change), ('json', change)]
+  assert libsnapshot.Revalidate(gerrit.url, 2, snapshot) is not snapshot
+  assert len(gerrit.requests) == 3
+
+
+def test_bound_leaves_unfinished_writes_alone():
+  settings = sublime.load_settings('Chromium.sublime-settings')
+  settings.set('snapshot_max_changes', 1)
+  try:
+    libsnapshot.Save(libsnapshot.Snapshot('https://a', '1', {}, {}))
+    oldest = libsnapshot._Path(libsnapshot._Key('https://a', '1'))
+    os.utime(oldest, (0, 0))
+    temporary = libsnapshot._Path('unfinished') + '.tmp'
+    with open(temporary, 'w') as f:
+      f.write('{')
+    libsnapshot.Save(libsnapshot.Snapshot('https://a', '2', {}, {}))
+    assert os.path.exists(temporary)
+    assert os.path.exists(libsnapshot._Path(libsnapshot._Key('https://a', '2')))
+    assert not os.path.exists(oldest)
+  finally:
+    settings.pop('snapshot_max_changes')
+    os.remove(temporary)
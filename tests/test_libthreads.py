@@ -0,0 +1,35 @@
+from conftest import Import
+
+libsnapshot = Import('libsnapshot')
+libthreads = Import('libthreads')
+
+
+def _Comment(comment_id:str, message:str, in_reply_to:str=None) -> dict:
+  comment = {'author': {'account_id': 1, 'name': 'R', 'email': 'r@x'},
+             'change_message_id': 'm', 'unresolved': True, 'patch_set': 1,
+             'id': comment_id, 'updated': comment_id, 'message': message,
+             'line': 2}
+  if in_reply_to:
+    comment['in_reply_to'] = in_reply_to
+  return comment
+
+
+def _Snapshot(change:dict, comments:list) -> 'libsnapshot.Snapshot':
+  return libsnapshot.Snapshot('https://gerrit', '1', change, {'a.cc': comments})
+
+
+def test_threads_follow_updated_without_meta_rev_id():
+  first = _Snapshot({'updated': 't1'}, [_Comment('c1', 'fix')])
+  assert list(libthreads.ThreadsForSnapshot(first)['a.cc']) == ['c1']
+
+  second = _Snapshot({'updated': 't2'},
+                     [_Comment('c1', 'fix'), _Comment('c2', 'done', 'c1')])
+  thread = libthreads.ThreadsForSnapshot(second)['a.cc']['c1']
+  assert [comment.id for comment in thread] == ['c1', 'c2']
+
+
+def test_threads_are_not_cached_without_any_version():
+  first = _Snapshot({}, [_Comment('c1', 'fix')])
+  libthreads.ThreadsForSnapshot(first)
+  second = _Snapshot({}, [_Comment('c3', 'new')])
+  assert list(libthreads.ThreadsForSnapshot(second)['a.cc']) == ['c3']